@@ -0,0 +1,133 @@
+"""
+Import time of the modules that are executed with python3 -m hades.*
+
+Every entry point is imported in a fresh interpreter a number of times and the
+fastest import is compared against a startup budget. Modules that are slow to
+import and not needed by an entry point (e.g. pyroute2 for
+hades.config.export, which is sourced by every command of the hades script)
+must not be imported at all.
+
+The exit status is non-zero if an entry point exceeds the budget or imports a
+forbidden module, so that the benchmark can be run as a check, e.g.::
+
+    HADES_CONFIG=/etc/hades/config.py \
+        python3 benchmarks/import_time.py --budget 150
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+HEAVY_MODULES = ('celery', 'flask', 'jinja2', 'pkg_resources', 'pyroute2',
+                 'sqlalchemy')
+
+# Entry points and the heavy modules they actually need
+ENTRY_POINTS = {
+    'hades.common.check_db': ('sqlalchemy',),
+    'hades.common.su': (),
+    'hades.config.check': (),
+    'hades.config.export': (),
+    'hades.config.generate': ('jinja2',),
+    'hades.dnsmasq.collector': ('sqlalchemy',),
+    'hades.dnsmasq.leases': (),
+    'hades.dnsmasq.monitor': (),
+    'hades.networking.configure': ('jinja2', 'pyroute2'),
+    'hades.vrrp.listener': ('pyroute2',),
+    'hades.vrrp.mirror': ('pyroute2',),
+    'hades.vrrp.notify': ('pyroute2',),
+    'hades.vrrp.timeline': (),
+}
+
+PROBE = """
+import sys, time
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+print(elapsed)
+print(' '.join(sys.modules))
+"""
+
+
+def measure(module, python):
+    """
+    Import a module in a fresh interpreter.
+    :return: Import time in seconds and the names of all imported modules
+    :rtype: (float, set[str])
+    """
+    output = subprocess.check_output(
+        [python, '-c', PROBE.format(module=module)],
+        universal_newlines=True)
+    elapsed, modules = output.splitlines()[-2:]
+    return float(elapsed), set(modules.split())
+
+
+def check_entry_point(module, allowed, python, repeat, budget):
+    times = []
+    modules = set()
+    for _ in range(repeat):
+        elapsed, modules = measure(module, python)
+        times.append(elapsed)
+    times.sort()
+    forbidden = sorted(m for m in HEAVY_MODULES
+                       if m not in allowed and m in modules)
+    best = times[0] * 1000
+    return {
+        'module': module,
+        'best_ms': best,
+        'median_ms': times[len(times) // 2] * 1000,
+        'modules': len(modules),
+        'forbidden_imports': forbidden,
+        'ok': best <= budget and not forbidden,
+    }
+
+
+def main(args):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('modules', nargs='*', metavar='MODULE',
+                        help="Entry points to check (default: all)")
+    parser.add_argument('--budget', type=float, default=250.0,
+                        help="Maximum import time in milliseconds "
+                             "(default: 250)")
+    parser.add_argument('--repeat', type=int, default=5,
+                        help="Number of imports per entry point, the fastest "
+                             "is used (default: 5)")
+    parser.add_argument('--python', default=sys.executable,
+                        help="Python interpreter (default: the current one)")
+    parser.add_argument('--json', action='store_true',
+                        help="Print results as JSON")
+    options = parser.parse_args(args[1:])
+    modules = options.modules or sorted(ENTRY_POINTS)
+    unknown = [m for m in modules if m not in ENTRY_POINTS]
+    if unknown:
+        print("Unknown entry points: {}".format(", ".join(unknown)),
+              file=sys.stderr)
+        return os.EX_USAGE
+    results = [check_entry_point(m, ENTRY_POINTS[m], options.python,
+                                 options.repeat, options.budget)
+               for m in modules]
+    if options.json:
+        json.dump({'budget_ms': options.budget, 'entry_points': results},
+                  sys.stdout, indent=2, sort_keys=True)
+        print()
+    else:
+        print_report(results, options.budget)
+    return os.EX_OK if all(r['ok'] for r in results) else os.EX_SOFTWARE
+
+
+def print_report(results, budget):
+    print("Import time budget: {:.0f} ms".format(budget))
+    width = max(len(r['module']) for r in results)
+    for r in results:
+        print("{:<{width}}  {:7.1f} ms (median {:7.1f} ms, {:4d} modules)"
+              "{}{}".format(r['module'], r['best_ms'], r['median_ms'],
+                            r['modules'],
+                            "" if r['best_ms'] <= budget else
+                            "  OVER BUDGET",
+                            "  imports " + ", ".join(r['forbidden_imports'])
+                            if r['forbidden_imports'] else "",
+                            width=width))
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
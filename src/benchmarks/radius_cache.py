@@ -0,0 +1,143 @@
+"""
+Benchmark of the authorize cache of freeRADIUS with radclient.
+
+Access-Requests for a number of synthetic MAC addresses are sent to the
+running RADIUS server with radclient. The cache is flushed with radmin first,
+so that the first round of requests misses the cache and queries the
+database (the rate without the cache), while the following rounds are
+answered from the cache. The benchmark has to be run as root or as the agent
+user to access the control socket, e.g.::
+
+    HADES_CONFIG=/etc/hades/config.py \
+        python3 benchmarks/radius_cache.py --users 1000 --json
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from hades.config.loader import get_config
+
+
+def make_macs(count):
+    """Locally administered unicast MAC addresses"""
+    return ['02:00:{:02x}:{:02x}:{:02x}:{:02x}'.format(
+        (i >> 24) & 0xff, (i >> 16) & 0xff, (i >> 8) & 0xff, i & 0xff)
+        for i in range(count)]
+
+
+def write_requests(f, macs, nas_ip_address):
+    """Write MAC authentication requests in the format of radclient -f"""
+    for mac in macs:
+        f.write('User-Name = "{0}"\n'
+                'User-Password = "{0}"\n'
+                'Calling-Station-Id = "{0}"\n'
+                'NAS-IP-Address = {1}\n'
+                'Service-Type = Call-Check\n\n'.format(mac, nas_ip_address))
+    f.flush()
+
+
+def flush_cache(control_socket):
+    """Expire all entries by setting the epoch of the cache module"""
+    command = ['radmin', '-f', control_socket,
+               '-e', 'set module config cache epoch {:d}'.format(
+                   int(time.time()))]
+    output = subprocess.check_output(command, stderr=subprocess.STDOUT,
+                                     universal_newlines=True)
+    # radmin prints errors of commands, but still exits successfully
+    if 'ERROR' in output:
+        raise OSError("Could not flush the cache: {}".format(output.strip()))
+
+
+def send_requests(filename, server, secret, parallel, timeout):
+    """
+    Send all requests of a file with radclient.
+    :return: Elapsed time in seconds and whether all requests were answered
+    """
+    command = ['radclient', '-q', '-f', filename, '-p', str(parallel),
+               '-r', '1', '-t', str(timeout), server, 'auth', secret]
+    start = time.perf_counter()
+    status = subprocess.call(command, stdout=subprocess.DEVNULL)
+    return time.perf_counter() - start, status == 0
+
+
+def run(macs, server, secret, control_socket, parallel, rounds, timeout):
+    with tempfile.NamedTemporaryFile('w', prefix='radclient-',
+                                     suffix='.txt') as f:
+        write_requests(f, macs, '127.0.0.1')
+        flush_cache(control_socket)
+        cold, ok = send_requests(f.name, server, secret, parallel, timeout)
+        warm = []
+        for _ in range(rounds):
+            elapsed, round_ok = send_requests(f.name, server, secret,
+                                              parallel, timeout)
+            warm.append(elapsed)
+            ok = ok and round_ok
+    return {
+        'users': len(macs),
+        'parallel': parallel,
+        'uncached_rate': len(macs) / cold,
+        'cached_rate': len(macs) / min(warm),
+        'speedup': cold / min(warm),
+        'ok': ok,
+    }
+
+
+def main(args):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--users', type=int, action='append',
+                        help="Number of distinct users, may be given "
+                             "multiple times (default: 100, 1000)")
+    parser.add_argument('--parallel', type=int, default=32,
+                        help="Number of outstanding requests (default: 32)")
+    parser.add_argument('--rounds', type=int, default=3,
+                        help="Number of cached rounds, the fastest is used "
+                             "(default: 3)")
+    parser.add_argument('--timeout', type=float, default=3,
+                        help="Timeout of a request in seconds (default: 3)")
+    parser.add_argument('--server',
+                        help="Server as host:port (default: localhost and "
+                             "HADES_RADIUS_AUTHENTICATION_PORT)")
+    parser.add_argument('--json', action='store_true',
+                        help="Print results as JSON")
+    options = parser.parse_args(args[1:])
+    config = get_config()
+    if not config['HADES_RADIUS_CACHE_TTL']:
+        print("The cache is disabled (HADES_RADIUS_CACHE_TTL is zero)",
+              file=sys.stderr)
+        return os.EX_CONFIG
+    server = options.server or '127.0.0.1:{}'.format(
+        config['HADES_RADIUS_AUTHENTICATION_PORT'])
+    results = []
+    for users in options.users or [100, 1000]:
+        try:
+            results.append(run(make_macs(users), server,
+                               config['HADES_RADIUS_LOCALHOST_SECRET'],
+                               config['HADES_RADIUS_CONTROL_SOCKET'],
+                               options.parallel, options.rounds,
+                               options.timeout))
+        except (OSError, subprocess.CalledProcessError) as e:
+            print("Could not run benchmark: {}".format(e), file=sys.stderr)
+            return os.EX_UNAVAILABLE
+    if options.json:
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+        print()
+    else:
+        print_report(results)
+    return os.EX_OK if all(r['ok'] for r in results) else os.EX_SOFTWARE
+
+
+def print_report(results):
+    print("{:>8} {:>8} {:>16} {:>16} {:>8}".format(
+        "users", "parallel", "uncached", "cached", "speedup"))
+    for r in results:
+        print("{:>8} {:>8} {:>12.0f} r/s {:>12.0f} r/s {:>7.1f}x{}".format(
+            r['users'], r['parallel'], r['uncached_rate'], r['cached_rate'],
+            r['speedup'], "" if r['ok'] else "  REQUESTS FAILED"))
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
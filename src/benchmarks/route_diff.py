@@ -0,0 +1,226 @@
+"""
+Benchmark of the route diffing of hades.vrrp.notify.sync_routes.
+
+A FakeIPRoute serves synthetic route dumps instead of the kernel and a
+FakeRouteBatch encodes the netlink requests without sending them, so that the
+benchmark runs without root and without touching the routing tables. The
+destination tables contain a configurable fraction of the routes of the
+source table and the same number of stale routes, that have to be deleted.
+
+The time of each phase of sync_routes (reading the dumps into filtered route
+sets with get_included_routes, diffing and encoding the requests with
+queue_changes) and of a complete sync_routes call is measured. The number of
+added and deleted routes is verified, e.g.::
+
+    python3 benchmarks/route_diff.py --routes 1000 --routes 100000 --json
+"""
+import argparse
+import json
+import os
+import socket
+import sys
+import time
+
+import netaddr
+
+from hades.vrrp.notify import (
+    PrefixSet, RT_TABLE_MAIN, RouteBatch, get_included_routes, queue_changes,
+    sync_routes)
+
+# Excluded networks, like HADES_USER_NETWORKS and HADES_UNAUTH_LISTEN
+EXCLUDES = (netaddr.IPNetwork('10.0.0.0/16'),
+            netaddr.IPNetwork('10.66.0.0/19'))
+# First /24 of the stale routes
+STALE_BASE = int(netaddr.IPAddress('100.64.0.0'))
+ROUTE_BASE = int(netaddr.IPAddress('10.0.0.0'))
+
+
+def make_rtmsg(table, address, prefixlen=24):
+    """
+    Synthetic route as returned by pyroute2 for a unicast route via a
+    gateway. Only item access is used by route_from_rtmsg, dicts are
+    therefore sufficient.
+    """
+    return {
+        'family': socket.AF_INET,
+        'dst_len': prefixlen,
+        'src_len': 0,
+        'tos': 0,
+        'table': table,
+        'proto': 4,
+        'scope': 0,
+        'type': 1,
+        'flags': 0,
+        'attrs': [
+            ['RTA_TABLE', table],
+            ['RTA_DST', socket.inet_ntoa(address.to_bytes(4, 'big'))],
+            ['RTA_GATEWAY', '192.0.2.1'],
+            ['RTA_OIF', 2],
+        ],
+    }
+
+
+class FakeIPRoute(object):
+    """Serve precomputed route dumps per table"""
+    def __init__(self, dumps):
+        """
+        :param dict[int, list[dict]] dumps: Routes per table
+        """
+        self.dumps = dumps
+
+    def get_routes(self, family=socket.AF_UNSPEC, table=None):
+        return [msg for msg in self.dumps.get(table, [])
+                if family in (socket.AF_UNSPEC, msg['family'])]
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class FakeRouteBatch(RouteBatch):
+    """Encode requests like RouteBatch, but don't send them"""
+    def __init__(self):
+        self.messages = []
+        self.changes = []
+        self.sent = 0
+        self.sent_bytes = 0
+
+    def commit(self):
+        self.sent += len(self.messages)
+        self.sent_bytes += sum(map(len, self.messages))
+        self.messages = []
+        self.changes = []
+        return []
+
+    def close(self):
+        pass
+
+
+def make_dumps(routes, overlap, tables):
+    """
+    Create the dumps of the source and the destination tables.
+    :param int routes: Number of routes of the source table
+    :param float overlap: Fraction of the routes of the source table, that
+    are already in the destination tables
+    :param tuple[int] tables: Destination tables
+    :return: Dumps and the expected number of added and deleted routes per
+    destination table
+    """
+    source = [make_rtmsg(RT_TABLE_MAIN, ROUTE_BASE + (i << 8))
+              for i in range(routes)]
+    excluded = PrefixSet(EXCLUDES)
+    # Routes of the excluded networks are neither added nor deleted
+    included = [i for i in range(routes)
+                if not excluded.contains(socket.AF_INET,
+                                         ROUTE_BASE + (i << 8), 24)]
+    present = included[:int(len(included) * overlap)]
+    stale = len(included) - len(present)
+    dumps = {RT_TABLE_MAIN: source}
+    for table in tables:
+        dumps[table] = (
+            [make_rtmsg(table, ROUTE_BASE + (i << 8)) for i in present] +
+            [make_rtmsg(table, STALE_BASE + (i << 8)) for i in range(stale)])
+    return dumps, len(included) - len(present), stale
+
+
+def measure_phases(dumps, tables):
+    """Time the helpers of sync_routes separately"""
+    timings = {}
+    ip = FakeIPRoute(dumps)
+    excludes = PrefixSet(EXCLUDES)
+    start = time.perf_counter()
+    routes = {table: get_included_routes(ip, table, excludes)
+              for table in dumps}
+    timings['read'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    batch = FakeRouteBatch()
+    for table in tables:
+        queue_changes(batch, table, routes[RT_TABLE_MAIN], routes[table])
+    batch.commit()
+    timings['queue'] = time.perf_counter() - start
+    return timings
+
+
+def run(routes, overlap, tables, repeat):
+    dumps, expected_added, expected_deleted = make_dumps(routes, overlap,
+                                                         tables)
+    phases = {}
+    totals = []
+    ok = True
+    for _ in range(repeat):
+        for phase, elapsed in measure_phases(dumps, tables).items():
+            phases[phase] = min(phases.get(phase, elapsed), elapsed)
+        batch = FakeRouteBatch()
+        start = time.perf_counter()
+        added, deleted, errors = sync_routes(
+            RT_TABLE_MAIN, tables, EXCLUDES, ip=FakeIPRoute(dumps),
+            batch=batch)
+        totals.append(time.perf_counter() - start)
+        ok = ok and (added == expected_added * len(tables) and
+                     deleted == expected_deleted * len(tables) and
+                     batch.sent == added + deleted and not errors)
+    return {
+        'routes': routes,
+        'overlap': overlap,
+        'tables': len(tables),
+        'added': expected_added * len(tables),
+        'deleted': expected_deleted * len(tables),
+        'phases_ms': {phase: elapsed * 1000
+                      for phase, elapsed in phases.items()},
+        'sync_routes_ms': min(totals) * 1000,
+        'ok': ok,
+    }
+
+
+def main(args):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--routes', type=int, action='append',
+                        help="Number of routes of the source table, may be "
+                             "given multiple times (default: 1000, 10000, "
+                             "100000)")
+    parser.add_argument('--overlap', type=float, default=0.9,
+                        help="Fraction of the routes, that are already in "
+                             "the destination tables (default: 0.9)")
+    parser.add_argument('--tables', type=int, default=2,
+                        help="Number of destination tables (default: 2)")
+    parser.add_argument('--repeat', type=int, default=3,
+                        help="Number of runs, the fastest is used "
+                             "(default: 3)")
+    parser.add_argument('--json', action='store_true',
+                        help="Print results as JSON")
+    options = parser.parse_args(args[1:])
+    if not 0 <= options.overlap <= 1:
+        parser.error("--overlap must be between 0 and 1")
+    sizes = options.routes or [1000, 10000, 100000]
+    tables = tuple(range(1, options.tables + 1))
+    results = [run(routes, options.overlap, tables, options.repeat)
+               for routes in sizes]
+    if options.json:
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+        print()
+    else:
+        print_report(results)
+    return os.EX_OK if all(r['ok'] for r in results) else os.EX_SOFTWARE
+
+
+def print_report(results):
+    phases = ('read', 'queue')
+    print("{:>8} {:>8} {:>8} {}{:>12}".format(
+        "routes", "added", "deleted",
+        "".join("{:>18}".format(p) for p in phases), "sync_routes"))
+    for r in results:
+        print("{:>8} {:>8} {:>8} {}{:>9.1f} ms{}".format(
+            r['routes'], r['added'], r['deleted'],
+            "".join("{:>15.1f} ms".format(r['phases_ms'][p])
+                    for p in phases),
+            r['sync_routes_ms'], "" if r['ok'] else "  WRONG RESULT"))
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
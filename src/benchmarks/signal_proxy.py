@@ -0,0 +1,253 @@
+"""
+Throughput benchmark for SignalProxyDaemon and SignalProxyClient.
+
+A SignalProxyDaemon is started with a harmless child (sleep with SIGHUP
+ignored) and hammered with SIGHUP requests from a number of concurrent
+SignalProxyClients. Afterwards a single client pipelines bursts of requests
+larger than ClientConnection.MAX_PENDING_REQUESTS/MAX_PENDING_RESPONSES to
+exercise the back pressure handling of the daemon.
+
+Run before and after any protocol or event-loop change to the monitor, e.g.::
+
+    python3 benchmarks/signal_proxy.py --clients 8 --duration 10 --json
+"""
+import argparse
+import collections
+import json
+import logging
+import multiprocessing
+import os
+import signal
+import sys
+import tempfile
+import threading
+import time
+
+from hades.dnsmasq.monitor import (
+    ClientConnection, Response, SignalProxyClient, SignalProxyDaemon, decode,
+    encode)
+
+CHILD_ARGS = ('sh', '-c', 'trap "" HUP; exec sleep infinity')
+
+
+def percentile(sorted_values, p):
+    """
+    Nearest-rank percentile of an already sorted sequence
+    :param Sequence[float] sorted_values: Sorted values
+    :param float p: Percentile between 0 and 100
+    """
+    if not sorted_values:
+        return float('nan')
+    rank = max(int(round(p / 100 * len(sorted_values))) - 1, 0)
+    return sorted_values[min(rank, len(sorted_values) - 1)]
+
+
+def run_daemon(sockfile):
+    daemon = SignalProxyDaemon(sockfile, CHILD_ARGS)
+    os._exit(daemon.run())
+
+
+def start_daemon(sockfile, timeout=5):
+    pid = os.fork()
+    if pid == 0:
+        try:
+            run_daemon(sockfile)
+        finally:
+            os._exit(os.EX_SOFTWARE)
+    deadline = time.monotonic() + timeout
+    while not os.path.exists(sockfile):
+        if time.monotonic() > deadline:
+            os.kill(pid, signal.SIGKILL)
+            raise RuntimeError("SignalProxyDaemon did not create {}"
+                               .format(sockfile))
+        time.sleep(0.01)
+    return pid
+
+
+def stop_daemon(pid):
+    os.kill(pid, signal.SIGTERM)
+    _, status = os.waitpid(pid, 0)
+    return status
+
+
+def hammer(sockfile, duration, start, results):
+    """Send SIGHUP as fast as possible until the duration has elapsed"""
+    connect_start = time.perf_counter()
+    client = SignalProxyClient(sockfile)
+    connect_time = time.perf_counter() - connect_start
+    responses = collections.Counter()
+    latencies = []
+    start.wait()
+    deadline = time.monotonic() + duration
+    try:
+        while time.monotonic() < deadline:
+            sent = time.perf_counter()
+            response = client.send_signal(signal.SIGHUP)
+            latencies.append(time.perf_counter() - sent)
+            responses[response.name] += 1
+    finally:
+        client.close()
+    results.put((connect_time, latencies, dict(responses)))
+
+
+def run_throughput(sockfile, clients, duration, timeout):
+    start = multiprocessing.Event()
+    results = multiprocessing.Queue()
+    workers = [multiprocessing.Process(target=hammer,
+                                       args=(sockfile, duration, start,
+                                             results))
+               for _ in range(clients)]
+    for worker in workers:
+        worker.start()
+    # Clients beyond SignalProxyDaemon.MAX_CONNECTIONS wait in the listen
+    # backlog until a connection slot becomes free.
+    started = time.perf_counter()
+    start.set()
+    collected = [results.get(timeout=duration + timeout)
+                 for _ in workers]
+    elapsed = time.perf_counter() - started
+    for worker in workers:
+        worker.join()
+    connect_times = sorted(c for c, _, _ in collected)
+    latencies = sorted(latency for _, ls, _ in collected
+                       for latency in ls)
+    responses = collections.Counter()
+    for _, _, r in collected:
+        responses.update(r)
+    return {
+        'clients': clients,
+        'duration': elapsed,
+        'signals': len(latencies),
+        'signals_per_second': len(latencies) / elapsed,
+        'responses': dict(responses),
+        'connect_max_ms': connect_times[-1] * 1000,
+        'latency_ms': {
+            'p50': percentile(latencies, 50) * 1000,
+            'p90': percentile(latencies, 90) * 1000,
+            'p99': percentile(latencies, 99) * 1000,
+            'p99.9': percentile(latencies, 99.9) * 1000,
+            'max': latencies[-1] * 1000 if latencies else float('nan'),
+        },
+    }
+
+
+def run_burst(sockfile, burst, timeout):
+    """
+    Pipeline a burst of requests without waiting for responses.
+
+    Responses are read concurrently, as the daemon stops reading requests if it
+    has MAX_PENDING_REQUESTS outstanding requests and can't send responses.
+    """
+    client = SignalProxyClient(sockfile)
+    client.conn.settimeout(timeout)
+    responses = collections.Counter()
+    error = []
+
+    def reader():
+        received = 0
+        try:
+            while received < burst:
+                data = client.conn.recv(burst - received)
+                if not data:
+                    error.append("Connection closed after {} responses"
+                                 .format(received))
+                    return
+                received += len(data)
+                responses.update(Response(decode(data[i:i + 1])).name
+                                 for i in range(len(data)))
+        except OSError as e:
+            error.append("{} after {} responses".format(e, received))
+
+    thread = threading.Thread(target=reader)
+    started = time.perf_counter()
+    thread.start()
+    try:
+        client.conn.sendall(encode(signal.SIGHUP) * burst)
+    except OSError as e:
+        error.append("Sending failed: {}".format(e))
+    thread.join()
+    elapsed = time.perf_counter() - started
+    client.close()
+    return {
+        'burst': burst,
+        'duration': elapsed,
+        'signals_per_second': sum(responses.values()) / elapsed,
+        'responses': dict(responses),
+        'error': error[0] if error else None,
+    }
+
+
+def main(args):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--clients', type=int, default=4,
+                        help="Number of concurrent clients (default: 4)")
+    parser.add_argument('--duration', type=float, default=5.0,
+                        help="Seconds to run the throughput test (default: 5)")
+    parser.add_argument('--burst', type=int, action='append',
+                        help="Size of a pipelined burst, may be given "
+                             "multiple times (default: 4 times "
+                             "MAX_PENDING_REQUESTS)")
+    parser.add_argument('--timeout', type=float, default=10.0,
+                        help="Timeout for clients to finish (default: 10)")
+    parser.add_argument('--json', action='store_true',
+                        help="Print results as JSON")
+    options = parser.parse_args(args[1:])
+    bursts = options.burst or [4 * ClientConnection.MAX_PENDING_REQUESTS]
+    logging.getLogger('hades.dnsmasq').setLevel(logging.WARNING)
+
+    with tempfile.TemporaryDirectory(prefix='hades-bench-') as tmpdir:
+        sockfile = os.path.join(tmpdir, 'signal.sock')
+        pid = start_daemon(sockfile)
+        try:
+            throughput = run_throughput(sockfile, options.clients,
+                                        options.duration, options.timeout)
+            burst_results = [run_burst(sockfile, burst, options.timeout)
+                             for burst in bursts]
+            # The daemon must still be serving after the bursts
+            alive = SignalProxyClient(sockfile)
+            survived = alive.send_signal(signal.SIGHUP, 1) is Response.OK
+            alive.close()
+        finally:
+            status = stop_daemon(pid)
+    results = {
+        'max_connections': SignalProxyDaemon.MAX_CONNECTIONS,
+        'max_pending_requests': ClientConnection.MAX_PENDING_REQUESTS,
+        'max_pending_responses': ClientConnection.MAX_PENDING_RESPONSES,
+        'throughput': throughput,
+        'bursts': burst_results,
+        'daemon_survived_bursts': survived,
+        'daemon_exit_status': status,
+    }
+    if options.json:
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+        print()
+    else:
+        print_report(results)
+    return os.EX_OK if survived else os.EX_SOFTWARE
+
+
+def print_report(results):
+    t = results['throughput']
+    print("SignalProxyDaemon (MAX_CONNECTIONS={}, MAX_PENDING_REQUESTS={}, "
+          "MAX_PENDING_RESPONSES={})"
+          .format(results['max_connections'], results['max_pending_requests'],
+                  results['max_pending_responses']))
+    print("Throughput: {} clients, {} signals in {:.2f} s, {:.0f} signals/s"
+          .format(t['clients'], t['signals'], t['duration'],
+                  t['signals_per_second']))
+    print("  latency ms: " + ", ".join(
+        "{}={:.3f}".format(k, t['latency_ms'][k])
+        for k in ('p50', 'p90', 'p99', 'p99.9', 'max')))
+    print("  slowest connect: {:.3f} ms".format(t['connect_max_ms']))
+    print("  responses: {}".format(t['responses']))
+    for burst in results['bursts']:
+        print("Burst of {}: {:.2f} ms, {:.0f} signals/s, responses {}{}"
+              .format(burst['burst'], burst['duration'] * 1000,
+                      burst['signals_per_second'], burst['responses'],
+                      ", error: " + burst['error'] if burst['error'] else ""))
+    print("Daemon survived bursts: {}".format(
+        results['daemon_survived_bursts']))
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
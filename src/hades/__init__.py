@@ -1,6 +1,7 @@
 from logging.config import fileConfig
-import pkg_resources
+import os.path
 
+__version__ = '0.1'
 
-fileConfig(pkg_resources.resource_filename(__name__, 'logging.ini'),
+fileConfig(os.path.join(os.path.dirname(__file__), 'logging.ini'),
            disable_existing_loggers=False)
@@ -1,14 +1,33 @@
 from celery import Celery
+from celery.signals import task_prerun
 from datetime import timedelta
 import logging
+import subprocess
+import time
 from sqlalchemy import select, and_
 
-from hades.common.db import (get_connection, radacct, radpostauth, utcnow)
+from hades.common.db import (
+    dhcplease, get_connection, radacct, radpostauth, utcnow)
 from hades.config.loader import get_config
+from hades.config.watch import ConfigWatcher, subscribe
+from hades.dnsmasq.leases import get_lease_index
 
 logger = logging.getLogger(__name__)
 app = Celery(__name__)
 app.config_from_object(get_config())
+# Celery uses SIGHUP itself, therefore the config file is only watched
+config_watcher = ConfigWatcher(signo=None)
+
+
+@task_prerun.connect
+def reload_config(**kwargs):
+    config_watcher.check()
+
+
+@subscribe
+def update_app_config(config, changed):
+    app.conf.update({name: config[name] for name in changed
+                     if name in config})
 
 
 @app.task(rate_limit='1/m')
@@ -18,19 +37,51 @@ def refresh():
     connection.execute("REFRESH MATERIALIZED VIEW radcheck")
     connection.execute("REFRESH MATERIALIZED VIEW radgroupcheck")
     connection.execute("REFRESH MATERIALIZED VIEW radgroupreply")
+    connection.execute("REFRESH MATERIALIZED VIEW radreply")
     connection.execute("REFRESH MATERIALIZED VIEW radusergroup")
+    if app.conf["HADES_RADIUS_CACHE_TTL"]:
+        flush_radius_cache()
+
+
+def flush_radius_cache():
+    """
+    Flush the authorize cache of freeRADIUS, so that the refreshed data is
+    used immediately.
+
+    Entries created before the epoch of the cache module are expired, the
+    epoch is therefore set to the current time.
+    """
+    command = ['radmin', '-f', app.conf["HADES_RADIUS_CONTROL_SOCKET"],
+               '-e', 'set module config cache epoch {:d}'.format(
+                   int(time.time()))]
+    try:
+        output = subprocess.check_output(command, stderr=subprocess.STDOUT,
+                                         universal_newlines=True, timeout=10)
+    except subprocess.CalledProcessError as e:
+        logger.error("Could not flush the RADIUS cache: %s", e.output.strip())
+        return
+    except (OSError, subprocess.TimeoutExpired) as e:
+        logger.error("Could not flush the RADIUS cache: %s", e)
+        return
+    # radmin prints errors of commands, but still exits successfully
+    if 'ERROR' in output:
+        logger.error("Could not flush the RADIUS cache: %s", output.strip())
 
 
 @app.task(rate_limit='1/m')
 def delete_old():
     logger.info("Deleting old records")
     connection = get_connection()
+    retention_interval = app.conf["HADES_RETENTION_INTERVAL"]
     result = connection.execute(radacct.delete().where(and_(
-        radacct.c.acctstoptime < utcnow() - app.conf["HADES_RETENTION_INTERVAL"]
+        radacct.c.acctstoptime < utcnow() - retention_interval
     )))
     result = connection.execute(radpostauth.delete().where(and_(
         radpostauth.c.authdate < utcnow() - timedelta(days=1)
     )))
+    result = connection.execute(dhcplease.delete().where(and_(
+        dhcplease.c.time < utcnow() - retention_interval
+    )))
 
 
 @app.task(bind=True)
@@ -43,3 +94,26 @@ def get_sessions(self, mac):
         .where(and_(radacct.c.username == mac,
                     radacct.c.acctstarttime >= utcnow() - timedelta(days=1))))
     return results.fetchall()
+
+
+@app.task(bind=True)
+def get_lease_macs(self, ips):
+    """
+    Get the MAC addresses holding a lease of the auth dnsmasq for the given
+    IP addresses from the lease file without a database query.
+    :param list[str] ips: IPv4 addresses
+    :return: Mapping of the IPs to MAC addresses or None
+    :rtype: dict[str, str|None]
+    """
+    return get_lease_index().lookup_macs(ips)
+
+
+@app.task(bind=True)
+def get_lease_ips(self, macs):
+    """
+    Get the IP addresses leased to the given MAC addresses by the auth dnsmasq.
+    :param list[str] macs: MAC addresses
+    :return: Mapping of the MACs to IP addresses or None
+    :rtype: dict[str, str|None]
+    """
+    return get_lease_index().lookup_ips(macs)
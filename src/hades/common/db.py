@@ -7,12 +7,25 @@ from sqlalchemy.dialects.postgresql import INET, MACADDR
 from sqlalchemy.ext.compiler import compiles
 from sqlalchemy.sql import expression
 from hades.config.loader import CheckWrapper, get_config
+from hades.config.watch import subscribe
 
 
 config = CheckWrapper(get_config())
 engine = create_engine(config.SQLALCHEMY_DATABASE_URI)
 metadata = MetaData(bind=engine)
 
+
+@subscribe
+def update_config(new_config, changed):
+    global config, engine
+    config = CheckWrapper(new_config)
+    if 'SQLALCHEMY_DATABASE_URI' in changed:
+        old_engine = engine
+        engine = create_engine(config.SQLALCHEMY_DATABASE_URI)
+        metadata.bind = engine
+        old_engine.dispose()
+
+
 dhcphost = Table(
     'dhcphost', metadata,
     Column('id', Integer, primary_key=True, nullable=False),
@@ -20,6 +33,18 @@ dhcphost = Table(
     Column('ipaddress', INET, nullable=False),
 )
 
+dhcplease = Table(
+    'dhcplease', metadata,
+    Column('id', BigInteger, primary_key=True, nullable=False),
+    Column('time', DateTime, nullable=False),
+    Column('action', String(3), nullable=False),
+    Column('mac', MACADDR, nullable=False),
+    Column('ipaddress', INET, nullable=False),
+    Column('hostname', String(255)),
+    Column('interface', String(15)),
+    Column('expires', DateTime),
+)
+
 nas = Table(
     'nas', metadata,
     Column('id', Integer, primary_key=True, nullable=False),
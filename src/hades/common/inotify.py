@@ -0,0 +1,114 @@
+"""
+Minimal ctypes binding of the Linux inotify API
+"""
+import collections
+import ctypes
+import ctypes.util
+import os
+import struct
+
+IN_ACCESS = 0x00000001
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_CLOSE_NOWRITE = 0x00000010
+IN_OPEN = 0x00000020
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_CLOEXEC = os.O_CLOEXEC
+IN_NONBLOCK = os.O_NONBLOCK
+
+_event_header = struct.Struct('iIII')
+_libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+
+Event = collections.namedtuple('Event', ('wd', 'mask', 'cookie', 'name'))
+
+
+def _check(result):
+    if result < 0:
+        code = ctypes.get_errno()
+        raise OSError(code, os.strerror(code))
+    return result
+
+
+class Inotify(object):
+    """
+    An inotify instance.
+
+    The instance is non-blocking by default, so that its file descriptor can be
+    used in poll loops or be queried opportunistically.
+    """
+    BUFFER_SIZE = 64 * 1024
+
+    def __init__(self, flags=IN_CLOEXEC | IN_NONBLOCK):
+        """
+        :raises OSError: if the inotify instance could not be created
+        """
+        self.fd = None
+        self.blocking = not flags & IN_NONBLOCK
+        self.fd = _check(_libc.inotify_init1(flags))
+
+    def fileno(self):
+        return self.fd
+
+    def add_watch(self, path, mask):
+        """
+        Add a watch for path or modify an existing watch.
+        :param str path: Path of a file or directory
+        :param int mask: Bitmask of IN_* events
+        :return: Watch descriptor
+        :raises OSError:
+        """
+        return _check(_libc.inotify_add_watch(self.fd, os.fsencode(path),
+                                              mask))
+
+    def rm_watch(self, wd):
+        _check(_libc.inotify_rm_watch(self.fd, wd))
+
+    def read_events(self):
+        """
+        Read all currently queued events.
+        :return: A list of events, which is empty if no event is available on
+        a non-blocking instance.
+        :rtype: list[Event]
+        """
+        events = []
+        while True:
+            try:
+                data = os.read(self.fd, self.BUFFER_SIZE)
+            except InterruptedError:
+                continue
+            except BlockingIOError:
+                return events
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = _event_header.unpack_from(data,
+                                                                     offset)
+                offset += _event_header.size
+                name = data[offset:offset + length].rstrip(b'\0')
+                offset += length
+                events.append(Event(wd, mask, cookie, os.fsdecode(name)))
+            if self.blocking:
+                return events
+
+    def close(self):
+        if self.fd is None:
+            return
+        fd, self.fd = self.fd, None
+        os.close(fd)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __del__(self):
+        self.close()
@@ -1,7 +1,11 @@
+import binascii
 import collections
+import contextlib
 import functools
 from functools import reduce
 import operator
+import os
+import stat
 
 
 def memoize(f):
@@ -13,9 +17,78 @@ def memoize(f):
             f._cache = f()
         return f._cache
 
+    def cache_get():
+        return f._cache
+
+    def cache_set(value):
+        f._cache = value
+
+    def cache_clear():
+        f._cache = None
+
+    wrapper.cache_get = cache_get
+    wrapper.cache_set = cache_set
+    wrapper.cache_clear = cache_clear
     return wrapper
 
 
+def create_temporary_file(directory, prefix):
+    """
+    Create a new file with a random name, whose permissions honour the umask
+    unlike :func:`tempfile.mkstemp`.
+    :return: File descriptor and path of the file
+    :rtype: (int, str)
+    """
+    while True:
+        path = os.path.join(directory, prefix + binascii.hexlify(
+            os.urandom(6)).decode('ascii'))
+        try:
+            fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL |
+                         os.O_CLOEXEC, 0o666)
+        except FileExistsError:
+            continue
+        return fd, path
+
+
+@contextlib.contextmanager
+def atomic_open(filename, mode='w', perms=None, **kwargs):
+    """
+    Open a temporary file in the directory of filename, that replaces filename
+    if the with block is left without an exception.
+
+    Readers therefore see either the old or the complete new file. If no
+    permissions are given, the file keeps the permissions and the owner of the
+    file it replaces, a new file gets the default permissions of the umask.
+    :param str filename: Path of the file
+    :param str mode: Either 'w' or 'wb'
+    :param int|None perms: Permissions of the file
+    :param kwargs: Additional arguments for :func:`open`
+    """
+    directory, basename = os.path.split(os.path.abspath(filename))
+    fd, tmp = create_temporary_file(directory, '.' + basename + '.')
+    try:
+        with open(fd, mode, **kwargs) as f:
+            if perms is not None:
+                os.fchmod(f.fileno(), perms)
+            else:
+                try:
+                    st = os.stat(filename)
+                except FileNotFoundError:
+                    pass
+                else:
+                    os.fchmod(f.fileno(), stat.S_IMODE(st.st_mode))
+                    try:
+                        os.fchown(f.fileno(), st.st_uid, st.st_gid)
+                    except PermissionError:
+                        pass
+            yield f
+            f.flush()
+        os.replace(tmp, filename)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
 class frozendict(collections.Mapping):
     def __init__(self, mapping_or_iterable=None, **kwargs):
         if mapping_or_iterable is None:
@@ -3,9 +3,9 @@ import socket
 import grp
 import pwd
 import collections
+import sys
 
 import netaddr
-from pyroute2.iproute import IPRoute
 
 
 class ConfigError(Exception):
@@ -17,7 +17,14 @@ class ConfigError(Exception):
         return "{}: {}".format(self.name, super(ConfigError, self).__str__())
 
 
-def check_option(config, option, value, runtime_checks=False):
+def check_option(config, option, value, runtime_checks=False, snapshot=None):
+    """
+    Check the value of an option.
+
+    If a :class:`SystemSnapshot` is given, runtime checks that have a snapshot
+    variant are evaluated against the snapshot instead of the system.
+    :raises ConfigError:
+    """
     name = option.__name__
     if option.type is not None and not isinstance(value, option.type):
         got = type(value).__name__
@@ -30,7 +37,86 @@ def check_option(config, option, value, runtime_checks=False):
     if option.static_check:
         option.static_check(config, name, value)
     if runtime_checks and option.runtime_check:
-        option.runtime_check(config, name, value)
+        check = option.runtime_check
+        variant = getattr(check, 'snapshot_variant', None)
+        if snapshot is not None and variant is not None:
+            variant(snapshot, config, name, value)
+        else:
+            check(config, name, value)
+
+
+def get_interfaces():
+    """
+    Get the names of all network interfaces with a single RTM_GETLINK dump.
+    :rtype: frozenset[str]
+    """
+    # pyroute2 is slow to import and only required for runtime checks
+    from pyroute2.iproute import IPRoute
+    ip = IPRoute()
+    try:
+        return frozenset(link.get_attr('IFLA_IFNAME')
+                         for link in ip.get_links())
+    finally:
+        ip.close()
+
+
+def get_addresses():
+    """
+    Get all addresses of all interfaces with a single RTM_GETADDR dump.
+    :return: Pairs of address and prefix length
+    :rtype: frozenset[(netaddr.IPAddress, int)]
+    """
+    from pyroute2.iproute import IPRoute
+    ip = IPRoute()
+    try:
+        return frozenset(
+            (netaddr.IPAddress(addr.get_attr('IFA_LOCAL') or
+                               addr.get_attr('IFA_ADDRESS')),
+             addr['prefixlen'])
+            for addr in ip.get_addr())
+    finally:
+        ip.close()
+
+
+class SystemSnapshot(object):
+    """
+    Snapshot of the network interfaces, addresses, users and groups of the
+    system, so that the runtime checks of all options can be evaluated without
+    querying the system for each option.
+    """
+    def __init__(self, interfaces, addresses, users, groups):
+        """
+        :param frozenset[str] interfaces: Interface names
+        :param frozenset[(netaddr.IPAddress, int)] addresses: Addresses and
+        prefix lengths
+        :param dict[str, pwd.struct_passwd] users: Users by name
+        :param dict[str, grp.struct_group] groups: Groups by name
+        """
+        self.interfaces = interfaces
+        self.addresses = addresses
+        self.users = users
+        self.groups = groups
+
+    @classmethod
+    def gather(cls):
+        """
+        Take a snapshot using one link and one address dump and reading the
+        passwd and group databases once.
+        """
+        return cls(get_interfaces(), get_addresses(),
+                   {p.pw_name: p for p in pwd.getpwall()},
+                   {g.gr_name: g for g in grp.getgrall()})
+
+
+def snapshot_variant(check):
+    """
+    Register the decorated function as the variant of a runtime check, that
+    takes a :class:`SystemSnapshot` as additional first argument.
+    """
+    def decorator(f):
+        check.snapshot_variant = f
+        return f
+    return decorator
 
 
 def greater_than(threshold):
@@ -48,6 +134,14 @@ def between(low, high):
     return checker
 
 
+def one_of(*values):
+    def checker(config, name, value):
+        if value not in values:
+            raise ConfigError(name, "Must be one of {}"
+                              .format(", ".join(map(repr, values))))
+    return checker
+
+
 def mapping(key_check=None, value_check=None):
     def f(config, name, value):
         for k, v in value.items():
@@ -121,15 +215,21 @@ def interface_exists(config, name, value):
         raise ConfigError(name, "Interface {} not found".format(value))
 
 
+@snapshot_variant(interface_exists)
+def interface_exists_in_snapshot(snapshot, config, name, value):
+    if value not in snapshot.interfaces:
+        raise ConfigError(name, "Interface {} not found".format(value))
+
+
 def address_exists(config, name, value):
-    ip = IPRoute()
-    if value.version == 4:
-        family = socket.AF_INET
-    elif value.version == 6:
-        family = socket.AF_INET6
-    else:
-        raise AssertionError("Unknown version {}".format(value.version))
-    if ip.get_addr(family=family, address=value.ip, prefixlen=value.prefixlen):
+    address_exists_in_snapshot(SystemSnapshot(None, get_addresses(), None,
+                                              None),
+                               config, name, value)
+
+
+@snapshot_variant(address_exists)
+def address_exists_in_snapshot(snapshot, config, name, value):
+    if (value.ip, value.prefixlen) not in snapshot.addresses:
         raise ConfigError(name, "No such address {}".format(value))
 
 
@@ -150,6 +250,14 @@ def user_exists(config, name, value):
         raise ConfigError(name, "User {} does not exists".format(value))
 
 
+@snapshot_variant(user_exists)
+def user_exists_in_snapshot(snapshot, config, name, value):
+    try:
+        return snapshot.users[value]
+    except KeyError:
+        raise ConfigError(name, "User {} does not exists".format(value))
+
+
 def group_exists(config, name, value):
     try:
         return grp.getgrnam(value)
@@ -157,6 +265,14 @@ def group_exists(config, name, value):
         raise ConfigError(name, "Group {} does not exists".format(value))
 
 
+@snapshot_variant(group_exists)
+def group_exists_in_snapshot(snapshot, config, name, value):
+    try:
+        return snapshot.groups[value]
+    except KeyError:
+        raise ConfigError(name, "Group {} does not exists".format(value))
+
+
 def has_key(name, value, *keys):
     obj = value
     path = []
@@ -181,3 +297,44 @@ def user_mapping_for_user_exists(user_option_name):
                                     "option {}"
                               .format(user_name, user_option_name))
     return checker
+
+
+# Addresses, that are added by keepalived, they don't exist before keepalived
+# has been started and on backup nodes
+VRRP_ADDRESS_OPTIONS = frozenset((
+    'HADES_AUTH_LISTEN',
+    'HADES_RADIUS_LISTEN',
+    'HADES_UNAUTH_LISTEN',
+    'HADES_VRRP_LISTEN',
+))
+
+
+def main(args):
+    """
+    Verify all options including the runtime checks against a single
+    snapshot of the system and print all errors.
+
+    --skip-vrrp-addresses skips the runtime checks of the addresses managed
+    by keepalived.
+    """
+    # The loader imports this module
+    from hades.config.loader import get_config, verify_config
+    runtime_checks = '--no-runtime-checks' not in args[1:]
+    if '--skip-vrrp-addresses' in args[1:]:
+        skip_runtime_checks = VRRP_ADDRESS_OPTIONS
+    else:
+        skip_runtime_checks = ()
+    try:
+        config = get_config()
+    except ConfigError as e:
+        print(e, file=sys.stderr)
+        return os.EX_CONFIG
+    errors = verify_config(config, runtime_checks,
+                           skip_runtime_checks=skip_runtime_checks)
+    for error in errors:
+        print(error, file=sys.stderr)
+    return os.EX_CONFIG if errors else os.EX_OK
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -1,10 +1,16 @@
+import argparse
+import hashlib
 import logging
+import os
 import re
 import collections
+import stat
+import sys
 
 import netaddr
 
-from hades.config.loader import get_config
+from hades.common.util import atomic_open
+from hades.config.loader import get_config, get_config_fingerprint
 
 
 logger = logging.getLogger('hades.config.export')
@@ -12,6 +18,9 @@ shell_types = (int, str, bool, netaddr.IPAddress, netaddr.IPNetwork)
 pattern = re.compile(r'([^a-zA-Z0-9_])')
 replacement = r'\\\1'
 
+ENV_FILE_FORMAT = '1'
+ENV_FILE_HEADER = "# Generated by python3 -m hades.config.export. Do not edit."
+
 
 def escape(value):
     """
@@ -21,8 +30,7 @@ def escape(value):
     return pattern.sub(replacement, str(value))
 
 
-def main():
-    config = get_config()
+def print_exports(config):
     for name, value in config.items():
         escaped_name = escape(str(name))
         if isinstance(value, shell_types):
@@ -43,5 +51,110 @@ def main():
             print("export {}".format(escaped_name))
 
 
+def env_file_body(config):
+    """
+    The variable assignments of an env file.
+
+    Only options with scalar values are exported, as neither systemd nor a
+    plain environment support arrays. Values are backslash escaped, which is
+    understood by both bash and systemd's EnvironmentFile=.
+    :rtype: str
+    """
+    return ''.join("{}={}\n".format(escape(str(name)), escape(value))
+                   for name, value in sorted(config.items())
+                   if isinstance(value, shell_types))
+
+
+def read_env_file_header(filename):
+    """
+    Read the header of an env file and verify its checksum.
+    :return: The header fields or None if the file does not exist, has a
+    different format or a wrong checksum
+    :rtype: dict[str, str]|None
+    """
+    try:
+        with open(filename, encoding='utf-8') as f:
+            lines = f.readlines()
+    except FileNotFoundError:
+        return None
+    header = {}
+    body_start = 0
+    for body_start, line in enumerate(lines):
+        if not line.startswith('#'):
+            break
+        key, sep, value = line[1:].strip().partition('=')
+        if sep:
+            header[key] = value
+    else:
+        body_start = len(lines)
+    if header.get('HADES_ENV_FILE_FORMAT') != ENV_FILE_FORMAT:
+        return None
+    body = ''.join(lines[body_start:])
+    checksum = hashlib.sha256(body.encode('utf-8')).hexdigest()
+    if header.get('HADES_ENV_FILE_CHECKSUM') != checksum:
+        logger.warning("Checksum of env file %s does not match", filename)
+        return None
+    return header
+
+
+def write_env_file(filename, force=False):
+    """
+    Write the config into an env file, unless the file has been generated from
+    the same config source already.
+
+    The file gets the group and the read permissions of the config file, as it
+    contains secrets.
+    :param str filename: Path of the env file
+    :param bool force: Write the file even if it is up to date
+    :return: Whether the file has been written
+    """
+    fingerprint = get_config_fingerprint()
+    header = read_env_file_header(filename)
+    if (not force and header is not None and
+            header.get('HADES_CONFIG_FINGERPRINT') == fingerprint):
+        # Mark the file as up to date for the modification time checks of
+        # the hades script
+        os.utime(filename)
+        return False
+    body = env_file_body(get_config())
+    checksum = hashlib.sha256(body.encode('utf-8')).hexdigest()
+    config_file = os.environ.get('HADES_CONFIG')
+    if config_file is not None:
+        config_stat = os.stat(config_file)
+        perms = stat.S_IMODE(config_stat.st_mode) & 0o640
+        gid = config_stat.st_gid
+    else:
+        perms, gid = 0o644, -1
+    with atomic_open(filename, 'w', perms=perms, encoding='utf-8') as f:
+        if os.geteuid() == 0:
+            os.fchown(f.fileno(), 0, gid)
+        f.write("{}\n".format(ENV_FILE_HEADER))
+        f.write("# HADES_ENV_FILE_FORMAT={}\n".format(ENV_FILE_FORMAT))
+        f.write("# HADES_CONFIG_FINGERPRINT={}\n".format(fingerprint))
+        f.write("# HADES_ENV_FILE_CHECKSUM={}\n".format(checksum))
+        f.write(body)
+    logger.debug("Wrote env file %s", filename)
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog='python3 -m hades.config.export',
+        description="Print the config as bash export statements or write it "
+                    "into an env file, that can be used by bash (with set -a) "
+                    "and as EnvironmentFile= of systemd units.")
+    parser.add_argument('--env-file', metavar='PATH',
+                        help="Write an env file, if it has not been "
+                             "generated from the same config source already")
+    parser.add_argument('--force', action='store_true',
+                        help="Write the env file, even if it is up to date")
+    options = parser.parse_args()
+    if options.env_file is None:
+        print_exports(get_config())
+        return os.EX_OK
+    write_env_file(options.env_file, options.force)
+    return os.EX_OK
+
+
 if __name__ == '__main__':
-    main()
+    sys.exit(main())
@@ -1,113 +1,150 @@
+import argparse
 import collections
 from functools import partial
+import hashlib
+import multiprocessing
 import os
 import os.path
-import shutil
+import stat
 import sys
-import itertools
+import time
 
 import jinja2
-from jinja2.exceptions import FilterArgumentError
-from jinja2.filters import environmentfilter
 import netaddr
-import pkg_resources
+from hades.common.util import atomic_open
 from hades.config.loader import get_config
+from hades.config.templating import (
+    COMPILED_TEMPLATES_DIRNAME, COMPILED_TEMPLATES_VERSION_FILE,
+    create_environment)
 
 
-def template_filter(name):
-    def decorator(f):
-        template_filter.registered[name] = f
-        return f
-    return decorator
-template_filter.registered = dict()
+class PrecompiledLoader(jinja2.BaseLoader):
+    """
+    Load templates from the modules created by
+    :func:`hades.config.templating.compile_templates`.
 
-
-@template_filter('unique')
-def do_unique(a):
-    return set(a)
-
-
-@template_filter('intersection')
-def do_intersection(a, b):
-    return set(a).intersection(set(b))
-
-
-@template_filter('difference')
-def do_difference(a, b):
-    return set(a).difference(set(b))
-
-
-@template_filter('symmetric_difference')
-def do_symmetric_difference(a, b):
-    return set(a).symmetric_difference(set(b))
-
-
-@template_filter('union')
-def do_union(a, b):
-    return set(a).union(set(b))
-
-
-@template_filter('min')
-def do_min(a):
-    return min(a)
-
-
-@template_filter('max')
-def do_max(a):
-    return max(a)
-
-
-@template_filter('sorted')
-@environmentfilter
-def do_sorted(env, iterable, *, attribute=None, item=None, reverse=False):
-    if attribute is None and item is None:
-        key = None
-    elif attribute is not None and item is not None:
-        raise FilterArgumentError("Only one of attribute and item may be"
-                                  "specified")
-    elif attribute is not None:
-        key = partial(env.getattr, attribute=attribute)
-    elif item is not None:
-        key = partial(env.getitem, argument=item)
-    return sorted(iterable, key=key, reverse=reverse)
-
-
-@template_filter('zip')
-def do_zip(*iterables):
-    return zip(*iterables)
-
-
-@template_filter('zip_longest')
-def do_zip_longest(*iterables, fillvalue=None):
-    return itertools.zip_longest(*iterables, fillvalue=fillvalue)
-
-
-@template_filter('dirname')
-def do_dirname(a):
-    return os.path.dirname(a)
+    A template is only loaded from its module, if the module is newer than the
+    template source and has been compiled by the same Jinja2 version. Otherwise
+    (e.g. in a development checkout) the template is compiled from source.
+    """
+    def __init__(self, template_dir, compiled_dir):
+        self.template_dir = template_dir
+        self.compiled_dir = compiled_dir
+        self.source_loader = jinja2.FileSystemLoader(template_dir)
+        self.module_loader = None
+        version_file = os.path.join(compiled_dir,
+                                    COMPILED_TEMPLATES_VERSION_FILE)
+        try:
+            with open(version_file, encoding='ascii') as f:
+                version = f.read().strip()
+        except OSError:
+            return
+        if version == jinja2.__version__:
+            self.module_loader = jinja2.ModuleLoader(compiled_dir)
+
+    def get_source(self, environment, template):
+        return self.source_loader.get_source(environment, template)
+
+    def list_templates(self):
+        return self.source_loader.list_templates()
+
+    def is_precompiled(self, name):
+        """Check if an up to date module of a template exists"""
+        if self.module_loader is None:
+            return False
+        module = os.path.join(self.compiled_dir,
+                              jinja2.ModuleLoader.get_module_filename(name))
+        source = os.path.join(self.template_dir, *name.split('/'))
+        try:
+            return os.stat(module).st_mtime >= os.stat(source).st_mtime
+        except OSError:
+            return False
+
+    def load(self, environment, name, globals=None):
+        if self.is_precompiled(name):
+            return self.module_loader.load(environment, name, globals)
+        return self.source_loader.load(environment, name, globals)
+
+
+class ChangeReport(object):
+    """
+    Files written by :class:`ConfigGenerator`.
+
+    Files, whose content did not change, are not written at all, so that
+    callers can skip reloading services if :attr:`changed` is false.
+    """
+    def __init__(self):
+        self.created = []
+        self.updated = []
+        self.unchanged = []
+
+    @property
+    def changed(self):
+        return bool(self.created or self.updated)
+
+    def __str__(self):
+        return "{} created, {} updated, {} unchanged".format(
+            len(self.created), len(self.updated), len(self.unchanged))
+
+
+def content_hash(data):
+    return hashlib.sha256(data).digest()
+
+
+def file_hash(path):
+    """
+    :return: The hash of the content of a file or None if it does not exist
+    """
+    try:
+        with open(path, 'rb') as f:
+            return content_hash(f.read())
+    except FileNotFoundError:
+        return None
+
+
+def write_if_changed(path, data, report, perms=None):
+    """
+    Atomically replace a file with data, if its content differs.
+    :param str path: Path of the file
+    :param bytes data: New content
+    :param ChangeReport report: Report to add the file to
+    :param int|None perms: Permissions of the file, by default an existing
+    file keeps its permissions and owner (see :func:`atomic_open`)
+    """
+    old_hash = file_hash(path)
+    if old_hash == content_hash(data):
+        report.unchanged.append(path)
+        return
+    with atomic_open(path, 'wb', perms=perms) as f:
+        f.write(data)
+    if old_hash is None:
+        report.created.append(path)
+    else:
+        report.updated.append(path)
 
 
 class ConfigGenerator(object):
     TEMPLATE_SUFFIX = ".j2"
 
-    def __init__(self, template_dir, config):
+    def __init__(self, template_dir, config, compiled_dir=None):
         self.config = config
         self.template_dir = template_dir
-        self.env = jinja2.Environment(
-            loader=jinja2.FileSystemLoader(self.template_dir),
-            auto_reload=False, autoescape=False, keep_trailing_newline=True,
-            undefined=jinja2.StrictUndefined,
-            extensions=['jinja2.ext.do', 'jinja2.ext.loopcontrols',
-                        'jinja2.ext.with_'],
-        )
-        self.env.globals.update({
-            'collections': collections,
-            'itertools': itertools,
-            'netaddr': netaddr,
-        })
-        self.env.filters.update(template_filter.registered)
+        if compiled_dir is None:
+            compiled_dir = os.path.join(os.path.dirname(template_dir),
+                                        COMPILED_TEMPLATES_DIRNAME)
+        self.env = create_environment(PrecompiledLoader(template_dir,
+                                                        compiled_dir))
+        self.env.globals['netaddr'] = netaddr
 
     def from_directory(self, name, target_dir):
+        """
+        Render a directory of templates and static files into target_dir.
+
+        Files are rendered into memory and only written (atomically), if their
+        content changed.
+        :rtype: ChangeReport
+        """
+        report = ChangeReport()
         source_base = os.path.join(self.template_dir, name)
         sources = collections.deque()
         sources.append(source_base)
@@ -125,12 +162,15 @@ class ConfigGenerator(object):
                     template_name = os.path.relpath(source, self.template_dir)
                     template = self.env.get_template(template_name)
                     target = target[:-len(self.TEMPLATE_SUFFIX)]
-                    with open(target, 'w', encoding='UTF-8') as f:
-                        stream = template.stream(BASE_DIRECTORY=target_dir,
-                                                 TARGET=target, **self.config)
-                        f.writelines(stream)
+                    data = template.render(BASE_DIRECTORY=target_dir,
+                                           TARGET=target, **self.config)
+                    write_if_changed(target, data.encode('UTF-8'), report)
                 else:
-                    shutil.copy(source, target)
+                    with open(source, 'rb') as f:
+                        data = f.read()
+                    perms = stat.S_IMODE(os.stat(source).st_mode)
+                    write_if_changed(target, data, report, perms)
+        return report
 
     def from_file(self, name, output):
         target = os.path.join(self.template_dir, name)
@@ -139,41 +179,185 @@ class ConfigGenerator(object):
             BASE_DIRECTORY=base_directory, TARGET=target, **self.config)
         output.writelines(stream)
 
+    def to_file(self, name, target_file):
+        """
+        Render a template into target_file, if its content changed.
+        :rtype: ChangeReport
+        """
+        target = os.path.join(self.template_dir, name)
+        base_directory = os.path.dirname(target)
+        data = self.env.get_template(name).render(
+            BASE_DIRECTORY=base_directory, TARGET=target, **self.config)
+        report = ChangeReport()
+        write_if_changed(target_file, data.encode('utf-8'), report)
+        return report
+
+
+# Templates, that are rendered into HADES_CONFIG_DIR by the hades script
+CONFIG_DIR_TEMPLATES = (
+    ('auth-dnsmasq.conf.j2', 'auth-dnsmasq.conf'),
+    ('freeradius', 'freeradius'),
+    ('keepalived.conf.j2', 'keepalived.conf'),
+    ('nginx', 'nginx'),
+    ('unauth-dnsmasq.conf.j2', 'unauth-dnsmasq.conf'),
+    ('unbound.conf.j2', 'unbound.conf'),
+    ('uwsgi.ini.j2', 'uwsgi.ini'),
+)
+
 
-def write_single_file_config(name, generator, args):
-    if len(args) < 3:
+def write_single_file_config(name, generator, target_file=None):
+    if target_file is None:
         generator.from_file(name, sys.stdout)
-    else:
-        target_file = args[2]
-        with open(target_file, 'w', encoding='utf-8') as f:
-            generator.from_file(name, f)
-    return 0
+        return os.EX_OK, None
+    return os.EX_OK, generator.to_file(name, target_file)
 
 
-def write_directory_config(name, generator, args):
-    if len(args) < 3:
-        return os.EX_USAGE
-    target_dir = args[2]
-    generator.from_directory(name, target_dir)
-    return 0
+def write_directory_config(name, generator, target_dir=None):
+    if target_dir is None:
+        return os.EX_USAGE, None
+    return os.EX_OK, generator.from_directory(name, target_dir)
+
+
+def write_config(name, generator, target=None):
+    """
+    Render a file or directory template.
+    :return: Exit status and the change report or None if nothing was written
+    :rtype: (int, ChangeReport|None)
+    """
+    source_path = os.path.join(generator.template_dir, name)
+    if os.path.isdir(source_path):
+        return write_directory_config(name, generator, target)
+    elif os.path.isfile(source_path):
+        return write_single_file_config(name, generator, target)
+    else:
+        print("No such file or directory {} in {}"
+              .format(name, generator.template_dir), file=sys.stderr)
+        return os.EX_NOINPUT, None
+
+
+def read_manifest(f):
+    """
+    Read a manifest of templates and their targets.
+
+    Each line contains the name of a template and a target separated by
+    whitespace. Empty lines and lines starting with # are ignored.
+    :param Iterable[str] f: Lines of the manifest
+    :rtype: list[(str, str)]
+    :raises ValueError: if a line is malformed
+    """
+    jobs = []
+    for lineno, line in enumerate(f, 1):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        fields = line.split()
+        if len(fields) != 2:
+            raise ValueError("Line {}: Expected template and target, got {!r}"
+                             .format(lineno, line))
+        jobs.append((fields[0], fields[1]))
+    return jobs
+
+
+_worker_generator = None
+
+
+def _init_worker(generator):
+    global _worker_generator
+    _worker_generator = generator
+
+
+def _render_job(job):
+    name, target = job
+    start = time.perf_counter()
+    try:
+        status, report = write_config(name, _worker_generator, target)
+    except Exception as e:
+        status, report = os.EX_SOFTWARE, None
+        print("Rendering {} failed: {}: {}"
+              .format(name, type(e).__name__, e), file=sys.stderr)
+    return name, target, status, report, time.perf_counter() - start
+
+
+def write_configs(generator, jobs, processes=1):
+    """
+    Render multiple templates using the same generator.
+
+    If processes is larger than one, the templates are rendered in parallel by
+    a pool of forked processes, that inherit the generator.
+    :param ConfigGenerator generator: Generator
+    :param list[(str, str)] jobs: Pairs of template names and targets
+    :param int processes: Number of processes
+    :return: Template name, target, exit status, change report and render
+    time in seconds for each job
+    :rtype: list[(str, str, int, ChangeReport|None, float)]
+    """
+    if processes <= 1 or len(jobs) <= 1:
+        _init_worker(generator)
+        return list(map(_render_job, jobs))
+    context = multiprocessing.get_context('fork')
+    with context.Pool(min(processes, len(jobs)), initializer=_init_worker,
+                      initargs=(generator,)) as pool:
+        return pool.map(_render_job, jobs, chunksize=1)
+
+
+def create_parser():
+    parser = argparse.ArgumentParser(
+        prog='python3 -m hades.config.generate',
+        description="Render a configuration template. A file template is "
+                    "written to stdout, if no target is given, a directory "
+                    "template requires a target directory.")
+    parser.add_argument('name', nargs='?', help="Name of the template")
+    parser.add_argument('target', nargs='?', help="Target file or directory")
+    batch = parser.add_mutually_exclusive_group()
+    batch.add_argument('--all', action='store_true',
+                       help="Render all templates of HADES_CONFIG_DIR")
+    batch.add_argument('--manifest', type=argparse.FileType('r'),
+                       help="Render the templates listed in a file of "
+                            "template and target pairs (- for stdin)")
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help="Number of templates to render in parallel in "
+                             "batch mode (default: 1)")
+    return parser
 
 
 def main(args):
-    if len(args) < 2:
+    parser = create_parser()
+    options = parser.parse_args(args[1:])
+    batch = options.all or options.manifest is not None
+    if batch == (options.name is not None):
+        parser.print_usage(sys.stderr)
         return os.EX_USAGE
     config = get_config()
-    template_dir = pkg_resources.resource_filename('hades.config', 'templates')
+    template_dir = os.path.join(os.path.dirname(__file__), 'templates')
     generator = ConfigGenerator(template_dir, config)
-    name = args[1]
-    source_path = os.path.join(template_dir, name)
-    if os.path.isdir(source_path):
-        return write_directory_config(name, generator, args)
-    elif os.path.isfile(source_path):
-        return write_single_file_config(name, generator, args)
+    if not batch:
+        status, _ = write_config(options.name, generator, options.target)
+        return status
+    if options.all:
+        jobs = [(name, os.path.join(config['HADES_CONFIG_DIR'], target))
+                for name, target in CONFIG_DIR_TEMPLATES]
     else:
-        print("No such file or directory {} in {}".format(name, template_dir),
+        with options.manifest:
+            try:
+                jobs = read_manifest(options.manifest)
+            except ValueError as e:
+                print("Invalid manifest {}: {}"
+                      .format(options.manifest.name, e), file=sys.stderr)
+                return os.EX_DATAERR
+    start = time.perf_counter()
+    results = write_configs(generator, jobs, options.jobs)
+    for name, target, status, report, elapsed in results:
+        if status != os.EX_OK:
+            result = "failed with {}".format(status)
+        else:
+            result = str(report)
+        print("{:8.1f} ms  {} -> {} ({})"
+              .format(elapsed * 1000, name, target, result),
               file=sys.stderr)
-        return os.EX_NOINPUT
+    print("{:8.1f} ms  total ({} templates, {} jobs)"
+          .format((time.perf_counter() - start) * 1000, len(results),
+                  options.jobs), file=sys.stderr)
+    return max((status for _, _, status, _, _ in results), default=os.EX_OK)
 
 
 if __name__ == '__main__':
@@ -1,10 +1,15 @@
 import collections
+import hashlib
 import logging
 import os
+import pickle
+import sys
 import types
 
-from hades.common.util import memoize
-from hades.config.check import check_option
+import hades
+from hades.common.util import atomic_open, memoize
+from hades.config import tuning
+from hades.config.check import ConfigError, SystemSnapshot, check_option
 from hades.config.options import OptionMeta
 
 logger = logging.getLogger(__name__)
@@ -45,9 +50,66 @@ class ConfigObject(collections.Mapping):
         return self._data.items()
 
 
+class LazyConfigObject(ConfigObject):
+    """
+    A config object, that evaluates callable option values (see
+    :func:`evaluate_callables`) on first access.
+
+    Dependencies between deferred options are resolved recursively, as
+    callables receive the lazy config object itself. The evaluated value
+    replaces the callable in the underlying dict.
+    """
+    def __init__(self, d):
+        self._data = d
+        self._evaluating = []
+
+    def __getitem__(self, name):
+        value = self._data[name]
+        if not callable(value):
+            return value
+        if name in self._evaluating:
+            cycle = self._evaluating[self._evaluating.index(name):] + [name]
+            raise ConfigError(name, "Cyclic dependency {}"
+                              .format(' -> '.join(cycle)))
+        self._evaluating.append(name)
+        try:
+            value = value(self, name)
+        finally:
+            self._evaluating.pop()
+        self._data[name] = value
+        return value
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name) from None
+
+    def __dir__(self):
+        return sorted(set(super().__dir__()).union(self._data))
+
+    def values(self):
+        return [self[name] for name in self._data]
+
+    def items(self):
+        return [(name, self[name]) for name in self._data]
+
+
 class CheckWrapper(collections.Mapping):
     """Wrapper around a config object that executes check functions if options
-    are accessed."""
+    are accessed.
+
+    The result of the verification of an option is memoized per process for
+    all wrappers, so that each option is verified at most once, as long as
+    neither the config object nor the value of the option change. Failed
+    verifications are memoized as well. Use :meth:`invalidate` if checks
+    could yield a different result, e.g. because an interface has been
+    created."""
+
+    # (option name, runtime_checks) -> (config, value, ConfigError or None)
+    _verified = {}
 
     def __init__(self, config, runtime_checks=True):
         super().__init__()
@@ -64,13 +126,55 @@ class CheckWrapper(collections.Mapping):
         self._verify(key, value)
         return value
 
+    def _lookup(self, key, runtime_checks, value):
+        entry = self._verified.get((key, runtime_checks))
+        if (entry is None or entry[0] is not self._config or
+                entry[1] is not value):
+            return None
+        return entry
+
     def _verify(self, key, value):
+        entry = self._lookup(key, self._runtime_checks, value)
+        if entry is None and not self._runtime_checks:
+            # A successful verification including the runtime checks implies
+            # that the static checks succeed
+            entry = self._lookup(key, True, value)
+            if entry is not None and entry[2] is not None:
+                entry = None
+        if entry is not None:
+            if entry[2] is not None:
+                raise entry[2]
+            return
         option = OptionMeta.options.get(key)
-        if option:
-            check_option(self._config, option, value, self._runtime_checks)
+        # Other exceptions than ConfigError are not memoized, the check is
+        # retried on the next access
+        try:
+            if option:
+                check_option(self._config, option, value,
+                             self._runtime_checks)
+        except ConfigError as e:
+            self._verified[key, self._runtime_checks] = (self._config, value,
+                                                         e)
+            raise
+        else:
+            self._verified[key, self._runtime_checks] = (self._config, value,
+                                                         None)
+
+    @classmethod
+    def invalidate(cls, *keys):
+        """
+        Forget the memoized verification results of the given options or of
+        all options, if no option is given.
+        """
+        if not keys:
+            cls._verified.clear()
+            return
+        for key in keys:
+            cls._verified.pop((key, False), None)
+            cls._verified.pop((key, True), None)
 
     def __len__(self):
-        len(self._config)
+        return len(self._config)
 
     def __contains__(self, x):
         return x in self._config
@@ -100,27 +204,217 @@ def check_config(config, runtime_checks=False):
             check_option(config, option, value, runtime_checks=runtime_checks)
 
 
+def verify_config(config, runtime_checks=True, snapshot=None,
+                  skip_runtime_checks=()):
+    """
+    Check all options and collect all errors instead of stopping at the first.
+
+    Runtime checks are evaluated against a single :class:`SystemSnapshot`,
+    which is taken if none is given.
+    :param Container[str] skip_runtime_checks: Options, whose runtime checks
+    are skipped
+    :return: All errors ordered by option name
+    :rtype: list[ConfigError]
+    """
+    if runtime_checks and snapshot is None:
+        snapshot = SystemSnapshot.gather()
+    errors = []
+    for name in sorted(config):
+        option = OptionMeta.options.get(name)
+        if not option:
+            continue
+        try:
+            check_option(config, option, config[name],
+                         runtime_checks and name not in skip_runtime_checks,
+                         snapshot)
+        except ConfigError as e:
+            errors.append(e)
+    return errors
+
+
+def find_dependency_cycle(config):
+    """
+    Find a cycle in the dependencies declared by callable option values (in
+    their dependencies attribute, see :func:`hades.config.options.equal_to`).
+    :return: Names of the options forming a cycle, the first name is repeated
+    at the end, or None if there is no cycle
+    :rtype: list[str]|None
+    """
+    graph = {name: getattr(value, 'dependencies', ())
+             for name, value in config.items() if callable(value)}
+    done = set()
+    for start in graph:
+        if start in done:
+            continue
+        path = [start]
+        iterators = [iter(graph[start])]
+        while iterators:
+            for dependency in iterators[-1]:
+                if dependency in path:
+                    return path[path.index(dependency):] + [dependency]
+                if dependency in graph and dependency not in done:
+                    path.append(dependency)
+                    iterators.append(iter(graph[dependency]))
+                    break
+            else:
+                done.add(path.pop())
+                iterators.pop()
+    return None
+
+
+def check_dependencies(config):
+    """
+    :raises ConfigError: if options depend on each other cyclically
+    """
+    cycle = find_dependency_cycle(config)
+    if cycle is not None:
+        raise ConfigError(cycle[0], "Cyclic dependency {}"
+                          .format(' -> '.join(cycle)))
+
+
 def evaluate_callables(config):
     """Option values may be callables that are evaluated after the full config
     has been loaded. They receive the config and the name of the option as
-    arguments"""
-    for name, value in config.items():
-        if callable(value):
-            config[name] = value(config, name)
+    arguments. Options they depend on are evaluated first.
+    :raises ConfigError: if options depend on each other cyclically"""
+    check_dependencies(config)
+    lazy = LazyConfigObject(config)
+    for name in list(config):
+        lazy[name]
 
 
-@memoize
-def get_config():
+def get_cache_filename():
+    """
+    Path of the cache of the evaluated config. The path can be set with the
+    HADES_CONFIG_CACHE environment variable. An empty value disables the cache.
+    """
+    return os.environ.get('HADES_CONFIG_CACHE', '/run/hades/config.cache')
+
+
+def get_source_fingerprint():
+    """
+    Names, sizes and modification times of the modules of this package, which
+    define the options and their defaults, so that changes of the installed
+    sources invalidate the cache without a version bump.
+    :rtype: tuple[(str, int, int)]
+    """
+    directory = os.path.dirname(os.path.abspath(__file__))
+    return tuple(sorted(
+        (entry.name, entry.stat().st_size, entry.stat().st_mtime_ns)
+        for entry in os.scandir(directory)
+        if entry.name.endswith('.py') and entry.is_file()))
+
+
+def get_cache_key(filename, source):
+    """
+    The cache key consists of the path and hash of the config file, the hades
+    version, the Python version, the fingerprint of the sources of this
+    package and the memory and CPUs of the node, that the defaults of the
+    tuning options are derived from.
+    """
+    return (hades.__version__, tuple(sys.version_info[:2]),
+            get_source_fingerprint(), tuning.get_resources(),
+            os.path.abspath(filename), hashlib.sha256(source).hexdigest())
+
+
+def get_config_fingerprint():
+    """
+    Get a fingerprint of the config source without evaluating the config.
+
+    The fingerprint changes if the config file, its path, the hades version,
+    the Python version, the sources of this package or the resources of the
+    node change.
+    :rtype: str
+    """
+    filename = os.environ.get('HADES_CONFIG')
+    if filename is None:
+        key = (hades.__version__, tuple(sys.version_info[:2]),
+               get_source_fingerprint(), tuning.get_resources(), None)
+    else:
+        with open(filename, 'rb') as f:
+            key = get_cache_key(filename, f.read())
+    return hashlib.sha256(repr(key).encode('utf-8')).hexdigest()
+
+
+def load_cached_config(key):
+    """
+    Load the evaluated config from the cache, if the cache is valid for the
+    given key.
+
+    The cache is only trusted, if it is owned by root or the current user and
+    is not writable by others.
+    :return: The config or None if the cache is invalid
+    """
+    cache_file = get_cache_filename()
+    if not cache_file:
+        return None
+    try:
+        with open(cache_file, 'rb') as f:
+            st = os.fstat(f.fileno())
+            if st.st_uid not in (0, os.geteuid()) or st.st_mode & 0o022:
+                logger.warning("Ignoring config cache %s (unsafe owner or "
+                               "permissions)", cache_file)
+                return None
+            if pickle.load(f) != key:
+                logger.debug("Config cache %s is outdated", cache_file)
+                return None
+            return pickle.load(f)
+    except FileNotFoundError:
+        return None
+    except PermissionError:
+        logger.debug("Can't read config cache %s (Permission denied)",
+                     cache_file)
+        return None
+    except Exception:
+        logger.warning("Could not load config cache %s", cache_file,
+                       exc_info=True)
+        return None
+
+
+def store_cached_config(key, config, source_stat):
+    """
+    Store the evaluated config in the cache.
+
+    The cache gets the group and the read permissions of the config file, as it
+    contains secrets as well. Failures are logged and otherwise ignored.
+    """
+    cache_file = get_cache_filename()
+    if not cache_file:
+        return
+    try:
+        with atomic_open(cache_file, 'wb',
+                         perms=source_stat.st_mode & 0o644) as f:
+            if os.geteuid() == 0:
+                os.fchown(f.fileno(), 0, source_stat.st_gid)
+            pickle.dump(key, f, pickle.HIGHEST_PROTOCOL)
+            pickle.dump(config, f, pickle.HIGHEST_PROTOCOL)
+    except (FileNotFoundError, PermissionError) as e:
+        logger.debug("Can't write config cache %s: %s", cache_file, e)
+    except Exception:
+        logger.warning("Could not write config cache %s", cache_file,
+                       exc_info=True)
+
+
+def load_config(lazy=False):
+    """
+    Load the config from the file given by the HADES_CONFIG environment
+    variable. Use :func:`get_config` to get the config of the process.
+
+    A lazy config evaluates deferred options on first access and skips the
+    static checks of all options (use a :class:`CheckWrapper` to check the
+    options that are accessed), unless the evaluated config is cached already.
+    This is much cheaper for tools, that only need a few options.
+    :param bool lazy: Return a :class:`LazyConfigObject`
+    """
     config = get_defaults()
     try:
         filename = os.environ['HADES_CONFIG']
     except KeyError:
         return ConfigObject(config)
-    d = types.ModuleType('hades.config.user')
-    d.__file__ = filename
     try:
-        with open(filename) as f:
-            exec(compile(f.read(), filename, 'exec'), d.__dict__)
+        with open(filename, 'rb') as f:
+            source = f.read()
+            source_stat = os.fstat(f.fileno())
     except FileNotFoundError:
         logger.exception("Config file %s not found", filename)
         raise
@@ -134,10 +428,27 @@ def get_config():
     except IOError as e:
         logger.exception("Config file %s (I/O error): %s", filename, str(e))
         raise
+    key = get_cache_key(filename, source)
+    cached = load_cached_config(key)
+    if cached is not None:
+        return ConfigObject(cached)
+    d = types.ModuleType('hades.config.user')
+    d.__file__ = filename
+    try:
+        exec(compile(source, filename, 'exec'), d.__dict__)
     except (SyntaxError, TypeError) as e:
         logger.exception("Config file %s has errors: %s", filename, str(e))
         raise
     config.update(from_object(d))
+    if lazy:
+        check_dependencies(config)
+        return LazyConfigObject(config)
     evaluate_callables(config)
     check_config(config)
+    store_cached_config(key, config, source_stat)
     return ConfigObject(config)
+
+
+@memoize
+def get_config():
+    return load_config()
@@ -5,8 +5,9 @@ import collections
 
 import netaddr
 
-from hades.config import check
+from hades.config import check, tuning
 from hades.config.check import ConfigError
+from hades.config.tuning import GB, MB
 
 
 class OptionMeta(type):
@@ -42,6 +43,7 @@ def equal_to(other):
             raise ConfigError(name, "Can not set equal to option {}, option is"
                                     " not defined"
                               .format(other_name))
+    f.dependencies = (other_name,)
     return f
 
 
@@ -61,14 +63,32 @@ def deferred_format(fmt_string, *args, **kwargs):
     def f(config, name):
         try:
             fmt_args = tuple(config[a] for a in args)
-            fmt_kwargs = {k: config[v] for k, v in kwargs}
+            fmt_kwargs = {k: config[v] for k, v in kwargs.items()}
         except KeyError as e:
             raise ConfigError(e.args[0], "Option is missing (required by {})"
                               .format(name)) from e
         return fmt_string.format(*fmt_args, **fmt_kwargs)
+    f.dependencies = args + tuple(kwargs.values())
     return f
 
 
+def refresh_interval(config, name):
+    """
+    Interval of the hades.agent.refresh task in the celerybeat schedule.
+    """
+    try:
+        schedule = config['CELERYBEAT_SCHEDULE']['refresh']['schedule']
+    except KeyError:
+        raise ConfigError(name, "No refresh task in CELERYBEAT_SCHEDULE")
+    if not isinstance(schedule, timedelta):
+        raise ConfigError(name, "The schedule of the refresh task is not a "
+                                "timedelta, the option must be set")
+    return schedule
+
+
+refresh_interval.dependencies = ('CELERYBEAT_SCHEDULE',)
+
+
 ###################
 # General options #
 ###################
@@ -122,6 +142,27 @@ class HADES_USER_NETWORKS(Option):
                              check.mapping(value_check=check.network_ip))
 
 
+class HADES_FIREWALL_BACKEND(Option):
+    """
+    Firewall used by hades networking: 'iptables' (iptables.j2 loaded with
+    iptables-restore) or 'nftables' (nftables.j2 loaded with nft -f, requires
+    nftables 0.9.2 or later for transport header matching)
+    """
+    type = str
+    default = 'iptables'
+    static_check = check.one_of('iptables', 'nftables')
+
+
+class HADES_FIREWALL_STATE_FILE(Option):
+    """
+    Path to the file, that records the firewall rules applied by hades
+    networking, so that subsequent runs only apply changed chains
+    """
+    default = '/run/hades/firewall.json'
+    type = str
+    runtime_check = check.file_creatable
+
+
 #######################
 # Hades Agent options #
 #######################
@@ -148,6 +189,16 @@ class HADES_AGENT_HOME(Option):
     runtime_check = check.directory_exists
 
 
+class HADES_AGENT_CONCURRENCY(Option):
+    """
+    Number of worker processes of the site node agent. Defaults to the number
+    of CPUs.
+    """
+    default = tuning.cpu_count
+    type = int
+    static_check = check.greater_than(0)
+
+
 ######################
 # PostgreSQL options #
 ######################
@@ -172,6 +223,79 @@ class HADES_POSTGRESQL_SOCKET(Option):
     runtime_check = check.directory_exists
 
 
+class HADES_POSTGRESQL_SHARED_BUFFERS(Option):
+    """
+    Size of the shared buffers of PostgreSQL in kilobytes. Defaults to a
+    quarter of the memory, between 128 MB and 8 GB.
+    """
+    default = tuning.memory_fraction(1 / 4, 128 * MB, 8 * GB)
+    type = int
+    static_check = check.greater_than(0)
+
+
+class HADES_POSTGRESQL_EFFECTIVE_CACHE_SIZE(Option):
+    """
+    Planner estimate of the memory available for caching data in kilobytes.
+    Defaults to half of the memory.
+    """
+    default = tuning.memory_fraction(1 / 2, 128 * MB, 1024 * GB)
+    type = int
+    static_check = check.greater_than(0)
+
+
+class HADES_POSTGRESQL_WORK_MEM(Option):
+    """
+    Memory of a single sort or hash operation in kilobytes. Defaults to a
+    quarter of the memory not used by the shared buffers divided by the
+    maximum number of connections, between 4 MB and 64 MB.
+    """
+    default = tuning.work_mem
+    type = int
+    static_check = check.greater_than(0)
+
+
+class HADES_POSTGRESQL_MAINTENANCE_WORK_MEM(Option):
+    """
+    Memory of maintenance operations like VACUUM and CREATE INDEX in
+    kilobytes. Defaults to a sixteenth of the memory, between 64 MB and 1 GB.
+    """
+    default = tuning.memory_fraction(1 / 16, 64 * MB, 1 * GB)
+    type = int
+    static_check = check.greater_than(0)
+
+
+class HADES_POSTGRESQL_MAX_CONNECTIONS(Option):
+    """
+    Maximum number of connections to PostgreSQL. Defaults to the sum of the
+    uWSGI workers, the RADIUS threads and the agent worker processes plus ten
+    connections for administration.
+    """
+    default = tuning.max_connections
+    type = int
+    static_check = check.greater_than(0)
+
+
+class HADES_POSTGRESQL_CHECKPOINT_SEGMENTS(Option):
+    """
+    Maximum number of 16 MB WAL segments between automatic checkpoints.
+    Defaults to twice the size of the shared buffers, between 3 and 64
+    segments.
+    """
+    default = tuning.checkpoint_segments
+    type = int
+    static_check = check.greater_than(0)
+
+
+class HADES_POSTGRESQL_MAX_WORKER_PROCESSES(Option):
+    """
+    Maximum number of background worker processes of PostgreSQL. Defaults to
+    the number of CPUs, but at least 8.
+    """
+    default = tuning.max_worker_processes
+    type = int
+    static_check = check.greater_than(0)
+
+
 class HADES_POSTGRESQL_FOREIGN_SERVER_FDW(Option):
     """Name of the foreign data wrapper extensions that should be used"""
     default = 'mysql_fdw'
@@ -401,6 +525,47 @@ class HADES_AUTH_DNSMASQ_SIGNAL_SOCKET(Option):
     runtime_check = check.file_creatable
 
 
+class HADES_AUTH_DNSMASQ_LEASE_SOCKET(Option):
+    """
+    Path to the Unix socket of the DHCP lease event collector. The dhcp-script
+    of the dnsmasq instance for authenticated users sends lease events to this
+    socket.
+    """
+    default = '/run/hades/agent/auth-dnsmasq-leases.sock'
+    type = str
+    runtime_check = check.file_creatable
+
+
+class HADES_AUTH_DNSMASQ_DHCP_SCRIPT(Option):
+    """
+    Path to the dhcp-script of the dnsmasq instance for authenticated users,
+    that forwards lease events to the DHCP lease event collector.
+    """
+    default = '/usr/local/bin/hades-dhcp-script'
+    type = str
+    runtime_check = check.file_exists
+
+
+class HADES_AUTH_DHCP_LEASE_BATCH_SIZE(Option):
+    """
+    Number of DHCP lease events after which the DHCP lease event collector
+    writes the received events into the database.
+    """
+    default = 100
+    type = int
+    static_check = check.greater_than(0)
+
+
+class HADES_AUTH_DHCP_LEASE_FLUSH_INTERVAL(Option):
+    """
+    Maximum time DHCP lease events are buffered by the DHCP lease event
+    collector before they are written into the database.
+    """
+    default = timedelta(milliseconds=500)
+    type = timedelta
+    static_check = check.greater_than(timedelta(0))
+
+
 class HADES_AUTH_DHCP_DOMAIN(Option):
     """DNS domain of authenticated users"""
     default = 'users.agdsn.de'
@@ -551,6 +716,16 @@ class HADES_RADIUS_GROUP(Option):
     runtime_check = check.group_exists
 
 
+class HADES_RADIUS_THREADS(Option):
+    """
+    Maximum number of threads of the freeRADIUS server. Every thread holds a
+    connection to the database.
+    """
+    default = 32
+    type = int
+    static_check = check.greater_than(0)
+
+
 class HADES_RADIUS_LISTEN(Option):
     """IP and network the RADIUS server is listening on"""
     type = netaddr.IPNetwork
@@ -601,6 +776,61 @@ class HADES_RADIUS_DATABASE_FAIL_REPLY_ATTRIBUTES(Option):
     }
 
 
+class HADES_RADIUS_CACHE_TTL(Option):
+    """
+    Time the results of the SQL authorize lookups are cached by freeRADIUS.
+    The agent flushes the cache after every refresh of the database, the TTL
+    only bounds the age of entries, if the flush fails. Defaults to the
+    interval of the refresh task. A TTL of zero disables the cache.
+    """
+    type = timedelta
+    default = refresh_interval
+    static_check = check.between(timedelta(0), timedelta(days=1))
+
+
+class HADES_RADIUS_CACHED_ATTRIBUTES(Option):
+    """
+    Attributes set by the SQL authorize lookups, that are stored in the cache,
+    as list:attribute, e.g. reply:Tunnel-Private-Group-Id. Both the reply
+    attributes and the control attributes set by the check items (e.g.
+    Auth-Type := Reject of a blocked user) have to be listed, as sql is not
+    run on a cache hit.
+    """
+    type = collections.Sequence
+    default = (
+        'control:Auth-Type',
+        'reply:Reply-Message',
+        'reply:Tunnel-Type',
+        'reply:Tunnel-Medium-Type',
+        'reply:Tunnel-Private-Group-Id',
+    )
+
+
+class HADES_RADIUS_CACHE_KEY_ATTRIBUTES(Option):
+    """
+    Request attributes, that make up the key of the cache. The key has to
+    contain every request attribute, that is compared by a check item of a
+    user or a group, as the check items are not evaluated on a cache hit.
+    The check and reply queries match NAS-IP-Address and NAS-Port-Id.
+    """
+    type = collections.Sequence
+    default = (
+        'User-Name',
+        'NAS-IP-Address',
+        'NAS-Port-Id',
+    )
+
+
+class HADES_RADIUS_CONTROL_SOCKET(Option):
+    """
+    Path to the control socket of the freeRADIUS server, that is used by the
+    agent to flush the cache with radmin
+    """
+    default = '/run/hades/radius/control.sock'
+    type = str
+    runtime_check = check.file_creatable
+
+
 ##########################
 # Gratuitous ARP options #
 ##########################
@@ -681,6 +911,57 @@ class HADES_VRRP_PREEMPTION_DELAY(Option):
     static_check = check.between(timedelta(seconds=0), timedelta(seconds=1000))
 
 
+class HADES_VRRP_NOTIFY_FIFO(Option):
+    """
+    Path to the FIFO, that keepalived writes state transitions to. The FIFO
+    is read by the VRRP listener.
+    """
+    default = '/run/hades/vrrp/notify.fifo'
+    type = str
+    runtime_check = check.file_creatable
+
+
+class HADES_VRRP_STATE_FILE(Option):
+    """
+    Path to the file, that contains the current VRRP state (MASTER, BACKUP or
+    FAULT) of the site node instance. The file is written by the VRRP
+    listener.
+    """
+    default = '/run/hades/vrrp/state'
+    type = str
+    runtime_check = check.file_creatable
+
+
+class HADES_VRRP_TIMELINE_FILE(Option):
+    """
+    Path to the file, that the VRRP listener appends the timeline of every
+    transition to MASTER to (see hades.vrrp.timeline).
+    """
+    default = '/var/lib/hades/vrrp/timeline.jsonl'
+    type = str
+
+
+class HADES_VRRP_PROBE_TIMEOUT(Option):
+    """
+    Time the VRRP listener waits for the unauth DNS server and the captive
+    portal to answer after a transition to MASTER.
+    """
+    type = timedelta
+    default = timedelta(seconds=10)
+    static_check = check.greater_than(timedelta(0))
+
+
+class HADES_ROUTE_MIRROR_RECONCILE_INTERVAL(Option):
+    """
+    Interval between full reconciliations of the auth and unauth routing
+    tables with the main table by the route mirror. Changes are mirrored
+    immediately, the reconciliation only repairs lost updates.
+    """
+    type = timedelta
+    default = timedelta(minutes=5)
+    static_check = check.greater_than(timedelta(0))
+
+
 ################
 # Test options #
 ################
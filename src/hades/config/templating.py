@@ -0,0 +1,142 @@
+"""
+Jinja2 environment of the configuration templates.
+
+This module does not import any other module of hades at import time, as
+setup.py loads it from the source tree with :func:`runpy.run_path` to
+precompile the templates without importing the hades package, which
+configures logging, and without the runtime dependencies of hades.
+"""
+import collections
+from functools import partial
+import itertools
+import os
+
+import jinja2
+from jinja2.exceptions import FilterArgumentError
+from jinja2.filters import environmentfilter
+
+
+def template_filter(name):
+    def decorator(f):
+        template_filter.registered[name] = f
+        return f
+    return decorator
+template_filter.registered = dict()
+
+
+@template_filter('unique')
+def do_unique(a):
+    return set(a)
+
+
+@template_filter('intersection')
+def do_intersection(a, b):
+    return set(a).intersection(set(b))
+
+
+@template_filter('difference')
+def do_difference(a, b):
+    return set(a).difference(set(b))
+
+
+@template_filter('symmetric_difference')
+def do_symmetric_difference(a, b):
+    return set(a).symmetric_difference(set(b))
+
+
+@template_filter('union')
+def do_union(a, b):
+    return set(a).union(set(b))
+
+
+@template_filter('min')
+def do_min(a):
+    return min(a)
+
+
+@template_filter('max')
+def do_max(a):
+    return max(a)
+
+
+@template_filter('sorted')
+@environmentfilter
+def do_sorted(env, iterable, *, attribute=None, item=None, reverse=False):
+    if attribute is None and item is None:
+        key = None
+    elif attribute is not None and item is not None:
+        raise FilterArgumentError("Only one of attribute and item may be"
+                                  "specified")
+    elif attribute is not None:
+        key = partial(env.getattr, attribute=attribute)
+    elif item is not None:
+        key = partial(env.getitem, argument=item)
+    return sorted(iterable, key=key, reverse=reverse)
+
+
+@template_filter('zip')
+def do_zip(*iterables):
+    return zip(*iterables)
+
+
+@template_filter('zip_longest')
+def do_zip_longest(*iterables, fillvalue=None):
+    return itertools.zip_longest(*iterables, fillvalue=fillvalue)
+
+
+@template_filter('dirname')
+def do_dirname(a):
+    return os.path.dirname(a)
+
+
+@template_filter('pgsize')
+def do_pgsize(a):
+    # Imported on use, see the module docstring
+    from hades.config.tuning import format_size
+    return format_size(a)
+
+
+def create_environment(loader):
+    """
+    Create the Jinja2 environment for the configuration templates.
+
+    The environment is shared by :class:`hades.config.generate.ConfigGenerator`
+    and :func:`compile_templates`, because precompiled templates are only
+    valid for the environment they have been compiled with. Globals, that are
+    only used while rendering, are added by the ConfigGenerator.
+    :param jinja2.BaseLoader loader: Template loader
+    """
+    env = jinja2.Environment(
+        loader=loader,
+        auto_reload=False, autoescape=False, keep_trailing_newline=True,
+        undefined=jinja2.StrictUndefined,
+        extensions=['jinja2.ext.do', 'jinja2.ext.loopcontrols',
+                    'jinja2.ext.with_'],
+    )
+    env.globals.update({
+        'collections': collections,
+        'itertools': itertools,
+    })
+    env.filters.update(template_filter.registered)
+    return env
+
+
+# Name of the directory next to the template directory, that contains the
+# templates precompiled by the compile_templates command of setup.py
+COMPILED_TEMPLATES_DIRNAME = 'compiled_templates'
+# File in the directory of the precompiled templates, that contains the
+# version of Jinja2 the templates have been compiled with
+COMPILED_TEMPLATES_VERSION_FILE = 'JINJA2_VERSION'
+
+
+def compile_templates(template_dir, target_dir, log_function=None):
+    """
+    Compile all templates in template_dir into Python modules in target_dir,
+    that can be loaded with :class:`PrecompiledLoader`.
+    """
+    env = create_environment(jinja2.FileSystemLoader(template_dir))
+    env.compile_templates(target_dir, extensions=['j2'], zip=None,
+                          log_function=log_function, ignore_errors=False)
+    version_file = os.path.join(target_dir, COMPILED_TEMPLATES_VERSION_FILE)
+    with open(version_file, 'w', encoding='ascii') as f:
+        f.write(jinja2.__version__)
@@ -0,0 +1,229 @@
+"""
+Defaults of the PostgreSQL tuning options, that are derived from the memory
+and the number of CPUs of the site node.
+
+The defaults follow the usual rules of thumb for a dedicated database server,
+scaled down, as PostgreSQL shares the site node with freeradius, the dnsmasq
+instances and the captive portal. All sizes are in kilobytes, the unit
+PostgreSQL uses by default. Running this module prints the chosen values::
+
+    python3 -m hades.config.tuning
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+
+logger = logging.getLogger(__name__)
+
+MEMINFO = '/proc/meminfo'
+# Memory limit of the cgroup of a container, cgroup v2 and v1. Docker mounts
+# the cgroup of the container at /sys/fs/cgroup.
+CGROUP_MEMORY_LIMITS = (
+    '/sys/fs/cgroup/memory.max',
+    '/sys/fs/cgroup/memory/memory.limit_in_bytes',
+)
+KB = 1
+MB = 1024 * KB
+GB = 1024 * MB
+# Connections for administration, cron jobs and the dnsmasq lease script in
+# addition to superuser_reserved_connections
+RESERVED_CONNECTIONS = 10
+# Size of a WAL segment
+WAL_SEGMENT_SIZE = 16 * MB
+# Memory assumed, if the total memory can't be determined
+DEFAULT_MEMORY = 1 * GB
+
+TUNING_OPTIONS = (
+    'HADES_POSTGRESQL_SHARED_BUFFERS',
+    'HADES_POSTGRESQL_EFFECTIVE_CACHE_SIZE',
+    'HADES_POSTGRESQL_WORK_MEM',
+    'HADES_POSTGRESQL_MAINTENANCE_WORK_MEM',
+    'HADES_POSTGRESQL_MAX_CONNECTIONS',
+    'HADES_POSTGRESQL_CHECKPOINT_SEGMENTS',
+    'HADES_POSTGRESQL_MAX_WORKER_PROCESSES',
+)
+
+
+def get_cgroup_memory_limit():
+    """
+    :return: The memory limit of the cgroup in kilobytes or None, if the
+    memory is not limited
+    :rtype: int|None
+    """
+    for filename in CGROUP_MEMORY_LIMITS:
+        try:
+            with open(filename) as f:
+                value = f.read().strip()
+        except OSError:
+            continue
+        if value == 'max':
+            return None
+        return int(value) // 1024
+    return None
+
+
+def get_total_memory():
+    """
+    The total memory of the node or the memory limit of the container, if it
+    is lower. /proc/meminfo shows the memory of the host inside containers.
+    If /proc/meminfo can't be read, DEFAULT_MEMORY is assumed.
+    :return: The total memory in kilobytes
+    :rtype: int
+    """
+    try:
+        with open(MEMINFO) as f:
+            for line in f:
+                if line.startswith('MemTotal:'):
+                    total = int(line.split()[1])
+                    break
+            else:
+                raise OSError("MemTotal missing in {}".format(MEMINFO))
+    except OSError as e:
+        logger.warning("Could not determine the total memory, assuming %s: "
+                       "%s", format_size(DEFAULT_MEMORY), e)
+        total = DEFAULT_MEMORY
+    limit = get_cgroup_memory_limit()
+    return total if limit is None else min(total, limit)
+
+
+def get_cpu_count():
+    return os.cpu_count() or 1
+
+
+def get_resources():
+    """
+    :return: The resources, that the defaults of the tuning options are
+    derived from
+    :rtype: (int, int)
+    """
+    return get_total_memory(), get_cpu_count()
+
+
+def depends_on(*names):
+    """Declare the options, a callable default depends on"""
+    def decorator(f):
+        f.dependencies = names
+        return f
+    return decorator
+
+
+def clamp(value, lower, upper):
+    return max(lower, min(value, upper))
+
+
+def clamp_size(value, lower, upper):
+    """Limit a size to a range and round it down to whole megabytes"""
+    value = clamp(value, lower, upper)
+    return value - value % MB if value > MB else value
+
+
+def memory_fraction(fraction, lower, upper):
+    """
+    Default of a size option, that is a fraction of the total memory.
+    :param float fraction: Fraction of the total memory
+    :param int lower: Minimum in kilobytes
+    :param int upper: Maximum in kilobytes
+    """
+    @depends_on()
+    def f(config, name):
+        return clamp_size(int(get_total_memory() * fraction), lower,
+                          upper)
+    return f
+
+
+@depends_on('HADES_POSTGRESQL_SHARED_BUFFERS',
+            'HADES_POSTGRESQL_MAX_CONNECTIONS')
+def work_mem(config, name):
+    """
+    Memory per sort or hash operation: A quarter of the memory, that is not
+    used by the shared buffers, divided among all connections.
+    """
+    available = (get_total_memory() -
+                 config['HADES_POSTGRESQL_SHARED_BUFFERS'])
+    connections = config['HADES_POSTGRESQL_MAX_CONNECTIONS']
+    per_connection = available // (4 * connections)
+    return clamp_size(per_connection, 4 * MB, 64 * MB)
+
+
+@depends_on('HADES_PORTAL_UWSGI_WORKERS', 'HADES_RADIUS_THREADS',
+            'HADES_AGENT_CONCURRENCY')
+def max_connections(config, name):
+    """
+    A connection for every uWSGI worker of the portal, every freeradius thread
+    and every agent worker process, and some reserved connections.
+    """
+    return (config['HADES_PORTAL_UWSGI_WORKERS'] +
+            config['HADES_RADIUS_THREADS'] +
+            config['HADES_AGENT_CONCURRENCY'] +
+            RESERVED_CONNECTIONS)
+
+
+@depends_on('HADES_POSTGRESQL_SHARED_BUFFERS')
+def checkpoint_segments(config, name):
+    """
+    Allow WAL of up to twice the size of the shared buffers between
+    checkpoints, so that checkpoints are mostly triggered by
+    checkpoint_timeout.
+    """
+    shared_buffers = config['HADES_POSTGRESQL_SHARED_BUFFERS']
+    segments = 2 * shared_buffers // WAL_SEGMENT_SIZE
+    return clamp(segments, 3, 64)
+
+
+@depends_on()
+def cpu_count(config, name):
+    return get_cpu_count()
+
+
+@depends_on()
+def max_worker_processes(config, name):
+    return max(8, get_cpu_count())
+
+
+def format_size(kilobytes):
+    """Format a size in kilobytes like PostgreSQL"""
+    for unit, size in (('GB', GB), ('MB', MB)):
+        if kilobytes >= size and kilobytes % size == 0:
+            return '{}{}'.format(kilobytes // size, unit)
+    return '{}kB'.format(kilobytes)
+
+
+def create_report(config):
+    """
+    :return: Detected resources and the chosen values of the tuning options
+    :rtype: dict
+    """
+    return {
+        'memory': get_total_memory(),
+        'cpus': get_cpu_count(),
+        'options': {name: config[name] for name in TUNING_OPTIONS},
+    }
+
+
+def main(args):
+    # The options import this module
+    from hades.config.loader import get_config
+    parser = argparse.ArgumentParser(
+        description="Print the PostgreSQL tuning options")
+    parser.add_argument('--json', action='store_true',
+                        help="Print the report as JSON")
+    options = parser.parse_args(args[1:])
+    report = create_report(get_config())
+    if options.json:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        print()
+        return os.EX_OK
+    print("Memory: {}, CPUs: {}".format(format_size(report['memory']),
+                                        report['cpus']))
+    for name in TUNING_OPTIONS:
+        value = report['options'][name]
+        if name.endswith(('_BUFFERS', '_SIZE', '_MEM')):
+            value = format_size(value)
+        print("{:<40} {:>8}".format(name, value))
+    return os.EX_OK
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,162 @@
+"""
+Hot reload of the config in long-running processes.
+
+Modules that derive state from the config register a callback with
+:func:`subscribe`. A :class:`ConfigWatcher` re-evaluates the config if the
+config file changes (or on a signal), replaces the config returned by
+:func:`hades.config.loader.get_config` and calls the callbacks with the
+changed options only.
+"""
+import logging
+import os
+import signal
+
+from hades.common import inotify
+from hades.config.loader import CheckWrapper, get_config, load_config
+
+logger = logging.getLogger(__name__)
+
+WATCH_MASK = (inotify.IN_CLOSE_WRITE | inotify.IN_MOVED_TO |
+              inotify.IN_CREATE)
+
+_subscribers = []
+
+
+def subscribe(callback, keys=None):
+    """
+    Register a callback, that is called with the new config and the names of
+    the changed options, if the config has been reloaded.
+
+    Callbacks are called in the order they have been registered. The return
+    value is the callback, so that subscribe can be used as a decorator.
+    :param callable callback: Function taking the config and a frozenset of
+    the changed option names
+    :param Iterable[str]|None keys: Only call the callback, if one of these
+    options changed
+    """
+    _subscribers.append((callback, frozenset(keys) if keys is not None
+                         else None))
+    return callback
+
+
+def unsubscribe(callback):
+    _subscribers[:] = [(c, k) for c, k in _subscribers if c is not callback]
+
+
+def diff_config(old, new):
+    """
+    :return: The names of the options, that have been added, removed or
+    changed
+    :rtype: frozenset[str]
+    """
+    return frozenset(name for name in set(old).union(new)
+                     if name not in old or name not in new or
+                     old[name] != new[name])
+
+
+def reload_config():
+    """
+    Re-evaluate the config and notify the subscribers about changed options.
+
+    If the new config can't be loaded, the exception is raised and the
+    current config stays in place.
+    :return: The names of the changed options
+    :rtype: frozenset[str]
+    """
+    old = get_config()
+    new = load_config()
+    changed = diff_config(old, new)
+    if not changed:
+        return changed
+    get_config.cache_set(new)
+    CheckWrapper.invalidate(*changed)
+    for callback, keys in list(_subscribers):
+        if keys is not None and not keys & changed:
+            continue
+        try:
+            callback(new, changed)
+        except Exception:
+            logger.exception("Config subscriber %r failed", callback)
+    return changed
+
+
+class ConfigWatcher(object):
+    """
+    Reload the config if the config file has been changed or a signal has
+    been received.
+
+    Changes of the config file are detected with inotify on its directory, so
+    that editors replacing the file are noticed as well. The watcher does not
+    run a thread, :meth:`check` must be called regularly, e.g. before every
+    request. A watcher may be created before the process forks, each process
+    watches the file on its own.
+    """
+    def __init__(self, filename=None, signo=signal.SIGHUP):
+        """
+        :param str|None filename: Config file (default: HADES_CONFIG)
+        :param int|None signo: Signal that requests a reload or None
+        """
+        if filename is None:
+            filename = os.environ.get('HADES_CONFIG')
+        self.filename = filename
+        self._reload_requested = False
+        self._inotify = None
+        self._pid = None
+        if signo is not None:
+            signal.signal(signo, self._request_reload)
+        self._watch()
+
+    def _request_reload(self, signo, frame):
+        self._reload_requested = True
+
+    def _watch(self):
+        self.close()
+        self._pid = os.getpid()
+        if self.filename is None:
+            return
+        directory = os.path.dirname(os.path.abspath(self.filename))
+        try:
+            self._inotify = inotify.Inotify()
+            self._inotify.add_watch(directory, WATCH_MASK)
+        except OSError as e:
+            logger.warning("Could not watch %s using inotify: %s",
+                           directory, e)
+            self.close()
+
+    def _changed(self):
+        if self._pid != os.getpid():
+            self._watch()
+        if self._inotify is None:
+            return False
+        basename = os.path.basename(self.filename)
+        return any(event.name == basename or
+                   event.mask & inotify.IN_Q_OVERFLOW
+                   for event in self._inotify.read_events())
+
+    def check(self):
+        """
+        Reload the config, if the file changed or a reload has been requested.
+
+        Errors in the new config are logged and the current config is kept.
+        :return: The names of the changed options
+        :rtype: frozenset[str]
+        """
+        changed = self._changed()
+        if not changed and not self._reload_requested:
+            return frozenset()
+        self._reload_requested = False
+        try:
+            changed = reload_config()
+        except Exception:
+            logger.exception("Could not reload config, keeping the current "
+                             "config")
+            return frozenset()
+        if changed:
+            logger.info("Reloaded config, changed options: %s",
+                        ", ".join(sorted(changed)))
+        return changed
+
+    def close(self):
+        if self._inotify is not None:
+            self._inotify.close()
+            self._inotify = None
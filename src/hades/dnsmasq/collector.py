@@ -0,0 +1,225 @@
+"""
+Collector for DHCP lease events of the auth dnsmasq instance.
+
+dnsmasq executes its dhcp-script for every lease event. The hades-dhcp-script
+sends each event as a single datagram to the Unix socket of the collector,
+which writes the events in batches into the dhcplease table.
+"""
+import collections
+from datetime import datetime
+import grp
+import logging
+import os
+import pwd
+import select
+import signal
+import socket
+import sys
+import time
+
+import netaddr
+from sqlalchemy.exc import DBAPIError
+
+from hades.common.db import dhcplease, get_connection
+from hades.common.su import drop_privileges
+from hades.config.loader import CheckWrapper, get_config
+
+logger = logging.getLogger(__name__)
+
+ACTIONS = frozenset(('add', 'old', 'del'))
+
+
+def parse_event(datagram, received):
+    """
+    Parse a lease event sent by the hades-dhcp-script.
+
+    Events are tab separated lines of action, MAC, IP, hostname, interface and
+    lease expiry time (seconds since the epoch). The last three fields may be
+    empty.
+    :param bytes datagram: Event
+    :param datetime received: Time the event was received (UTC)
+    :return: A row of the dhcplease table
+    :rtype: dict
+    :raises ValueError: if the event is malformed
+    """
+    line = datagram.decode('ascii', errors='replace').rstrip('\n')
+    fields = line.split('\t')
+    if len(fields) != 6:
+        raise ValueError("Expected 6 fields, got {}".format(len(fields)))
+    action, mac, ip, hostname, interface, expires = fields
+    if action not in ACTIONS:
+        raise ValueError("Unknown action {}".format(action))
+    try:
+        mac = netaddr.EUI(mac, dialect=netaddr.mac_unix_expanded)
+        ip = netaddr.IPAddress(ip)
+    except netaddr.AddrFormatError as e:
+        raise ValueError(str(e)) from e
+    return {
+        'time': received,
+        'action': action,
+        'mac': str(mac),
+        'ipaddress': str(ip),
+        'hostname': hostname or None,
+        'interface': interface or None,
+        'expires': (datetime.utcfromtimestamp(int(expires))
+                    if expires else None),
+    }
+
+
+class LeaseEventCollector(object):
+    """
+    Receive lease events on a Unix datagram socket and insert them in batches.
+
+    Events are written with a single multi-row INSERT after batch_size events
+    have been received or flush_interval seconds after the oldest buffered
+    event has been received, whichever comes first. If the database is
+    unavailable, events are kept, but at most MAX_BUFFERED_EVENTS, and the
+    insert is retried every flush_interval seconds.
+    """
+    MAX_BUFFERED_EVENTS = 100000
+    MAX_DATAGRAM_SIZE = 4096
+
+    def __init__(self, sockfile, batch_size, flush_interval):
+        """
+        :param str sockfile: Path of the Unix socket to listen on
+        :param int batch_size: Number of events that triggers a flush
+        :param float flush_interval: Seconds after which buffered events are
+        flushed
+        """
+        self.sockfile = sockfile
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.events = collections.deque(maxlen=self.MAX_BUFFERED_EVENTS)
+        self.flush_deadline = None
+        self.failed = False
+        if os.path.exists(sockfile):
+            os.unlink(sockfile)
+        logger.info("Listening on %s", sockfile)
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.socket.bind(sockfile)
+        self.socket.setblocking(False)
+
+    def _shutdown_handler(self, signo, frame):
+        # Only set a flag, raising here could interrupt a flush in the middle
+        # of a database operation. The main loop is woken up by the write of
+        # the signal number to the wakeup fd.
+        self.shutdown = True
+
+    def run(self):
+        self.shutdown = False
+        options = os.O_CLOEXEC | os.O_NONBLOCK
+        sig_read_fd, sig_write_fd = os.pipe2(options)
+        signal.set_wakeup_fd(sig_write_fd)
+        for signo in (signal.SIGTERM, signal.SIGINT, signal.SIGQUIT):
+            signal.signal(signo, self._shutdown_handler)
+        poll = select.poll()
+        poll.register(self.socket, select.POLLIN)
+        poll.register(sig_read_fd, select.POLLIN)
+        try:
+            while not self.shutdown:
+                if self.flush_deadline is None:
+                    timeout = None
+                else:
+                    timeout = max(self.flush_deadline - time.monotonic(), 0)
+                    timeout = int(timeout * 1000)
+                try:
+                    reported = dict(poll.poll(timeout))
+                except InterruptedError:
+                    continue
+                if sig_read_fd in reported:
+                    self.drain_signals(sig_read_fd)
+                if self.shutdown:
+                    break
+                if self.socket.fileno() in reported:
+                    self.receive_events()
+                if (len(self.events) >= self.batch_size and not self.failed or
+                        self.flush_deadline is not None and
+                        time.monotonic() >= self.flush_deadline):
+                    self.flush()
+            logger.info("Shutting down")
+        finally:
+            signal.set_wakeup_fd(-1)
+            os.close(sig_write_fd)
+            os.close(sig_read_fd)
+            self.flush()
+            self.socket.close()
+        return os.EX_OK
+
+    @staticmethod
+    def drain_signals(fd):
+        """Read all signal numbers written to the wakeup fd"""
+        while True:
+            try:
+                if not os.read(fd, 128):
+                    return
+            except InterruptedError:
+                continue
+            except BlockingIOError:
+                return
+
+    def receive_events(self):
+        """Read all available events from the socket"""
+        while True:
+            try:
+                datagram = self.socket.recv(self.MAX_DATAGRAM_SIZE)
+            except InterruptedError:
+                continue
+            except BlockingIOError:
+                return
+            try:
+                event = parse_event(datagram, datetime.utcnow())
+            except ValueError as e:
+                logger.warning("Ignoring malformed lease event %r: %s",
+                               datagram, e)
+                continue
+            if len(self.events) == self.events.maxlen:
+                logger.error("Too many buffered events, dropping oldest")
+            self.events.append(event)
+            if self.flush_deadline is None:
+                self.flush_deadline = time.monotonic() + self.flush_interval
+
+    def flush(self):
+        """Write all buffered events into the database"""
+        if not self.events:
+            return
+        try:
+            connection = get_connection()
+            try:
+                while self.events:
+                    rows = [self.events[i] for i in
+                            range(min(self.batch_size, len(self.events)))]
+                    connection.execute(dhcplease.insert().values(rows))
+                    for _ in rows:
+                        self.events.popleft()
+                    logger.debug("Inserted %d lease events", len(rows))
+            finally:
+                connection.close()
+        except DBAPIError as e:
+            logger.error("Could not insert %d lease events: %s",
+                         len(self.events), e)
+            # Retry after another flush interval
+            self.failed = True
+            self.flush_deadline = time.monotonic() + self.flush_interval
+            return
+        self.failed = False
+        self.flush_deadline = None
+
+
+def main():
+    logger.info("DHCP lease event collector")
+    config = CheckWrapper(get_config())
+    passwd = pwd.getpwnam(config['HADES_AGENT_USER'])
+    group = grp.getgrgid(passwd.pw_gid)
+    dnsmasq_group = grp.getgrnam(config['HADES_AUTH_DNSMASQ_GROUP'])
+    sockfile = config['HADES_AUTH_DNSMASQ_LEASE_SOCKET']
+    collector = LeaseEventCollector(
+        sockfile, config['HADES_AUTH_DHCP_LEASE_BATCH_SIZE'],
+        config['HADES_AUTH_DHCP_LEASE_FLUSH_INTERVAL'].total_seconds())
+    os.chown(sockfile, passwd.pw_uid, dnsmasq_group.gr_gid)
+    os.chmod(sockfile, 0o660)
+    drop_privileges(passwd, group)
+    sys.exit(collector.run())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,285 @@
+"""
+In-memory index of the DHCP leases of the auth dnsmasq instance.
+
+The lease file is parsed once and re-read only if inotify reports that dnsmasq
+has rewritten it, so that lookups are a dictionary access in the common case.
+"""
+import logging
+import os
+import socket
+import sys
+
+import netaddr
+
+from hades.common import inotify
+from hades.common.util import memoize
+from hades.config.loader import CheckWrapper, get_config, load_config
+from hades.config.watch import subscribe
+
+logger = logging.getLogger(__name__)
+
+WATCH_MASK = (inotify.IN_MODIFY | inotify.IN_CLOSE_WRITE |
+              inotify.IN_MOVED_TO | inotify.IN_CREATE | inotify.IN_DELETE)
+
+
+def parse_ip(ip):
+    """
+    Convert an IPv4 address into an integer
+    :param str|netaddr.IPAddress ip: IPv4 address
+    :raises ValueError: if ip is not a valid IPv4 address
+    """
+    if isinstance(ip, netaddr.IPAddress):
+        return int(ip)
+    try:
+        return int.from_bytes(socket.inet_aton(ip), 'big')
+    except OSError as e:
+        raise ValueError("Invalid IP address {}".format(ip)) from e
+
+
+def parse_mac(mac):
+    """
+    Convert a MAC address into an integer
+    :param str|netaddr.EUI mac: MAC address
+    :raises ValueError: if mac is not a valid MAC address
+    """
+    if isinstance(mac, netaddr.EUI):
+        return int(mac)
+    digits = str(mac).replace(':', '').replace('-', '')
+    if len(digits) != 12:
+        raise ValueError("Invalid MAC address {}".format(mac))
+    try:
+        return int(digits, 16)
+    except ValueError as e:
+        raise ValueError("Invalid MAC address {}".format(mac)) from e
+
+
+def format_ip(ip):
+    return socket.inet_ntoa(ip.to_bytes(4, 'big'))
+
+
+def format_mac(mac):
+    """Format a MAC address like arpreq does (lower case, colon separated)"""
+    return ':'.join('{:02x}'.format(b) for b in mac.to_bytes(6, 'big'))
+
+
+def parse_lease_file(f):
+    """
+    Parse a dnsmasq lease file.
+
+    Only IPv4 leases are returned. dnsmasq writes IPv6 leases after a line
+    starting with duid.
+    :param Iterable[str] f: Lines of the lease file
+    :return: Pairs of IP and MAC addresses as integers
+    :rtype: Iterable[(int, int)]
+    """
+    for line in f:
+        fields = line.split()
+        if not fields:
+            continue
+        if fields[0] == 'duid':
+            return
+        if len(fields) < 3:
+            logger.warning("Ignoring malformed lease %r", line)
+            continue
+        try:
+            yield parse_ip(fields[2]), parse_mac(fields[1])
+        except ValueError as e:
+            logger.warning("Ignoring malformed lease %r: %s", line, e)
+
+
+class LeaseIndex(object):
+    """
+    IP to MAC and MAC to IP index of a dnsmasq lease file.
+
+    Addresses are stored as integers in two dicts. Every lookup checks for
+    pending inotify events on the directory of the lease file and re-reads the
+    file if it has been changed. If inotify is not available, the stat
+    information of the file is compared instead.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.directory, self.basename = os.path.split(
+            os.path.abspath(filename))
+        self.ip_to_mac = {}
+        self.mac_to_ip = {}
+        self._stat = None
+        self._inotify = None
+        try:
+            self._inotify = inotify.Inotify()
+            self._inotify.add_watch(self.directory, WATCH_MASK)
+        except OSError as e:
+            logger.warning("Could not watch %s using inotify, falling back "
+                           "to stat: %s", self.directory, e)
+            if self._inotify is not None:
+                self._inotify.close()
+                self._inotify = None
+        self.reload()
+
+    def fileno(self):
+        """File descriptor that becomes readable if the lease file changed"""
+        return self._inotify.fileno() if self._inotify is not None else None
+
+    def _changed(self):
+        if self._inotify is not None:
+            return any(event.name == self.basename or
+                       event.mask & inotify.IN_Q_OVERFLOW
+                       for event in self._inotify.read_events())
+        return self._get_stat() != self._stat
+
+    def _get_stat(self):
+        try:
+            st = os.stat(self.filename)
+        except FileNotFoundError:
+            return None
+        return st.st_ino, st.st_size, st.st_mtime_ns
+
+    def refresh(self):
+        """
+        Re-read the lease file, if it has been changed.
+        :return: True, if the lease file has been re-read
+        """
+        if not self._changed():
+            return False
+        self.reload()
+        return True
+
+    def reload(self):
+        """Unconditionally re-read the lease file."""
+        self._stat = self._get_stat()
+        ip_to_mac = {}
+        mac_to_ip = {}
+        try:
+            with open(self.filename, encoding='ascii',
+                      errors='replace') as f:
+                for ip, mac in parse_lease_file(f):
+                    ip_to_mac[ip] = mac
+                    mac_to_ip[mac] = ip
+        except FileNotFoundError:
+            logger.info("Lease file %s does not exist (yet)", self.filename)
+        except PermissionError:
+            logger.error("Can't read lease file %s (Permission denied)",
+                         self.filename)
+        self.ip_to_mac = ip_to_mac
+        self.mac_to_ip = mac_to_ip
+        logger.debug("Loaded %d leases from %s", len(ip_to_mac),
+                     self.filename)
+
+    def lookup_mac(self, ip):
+        """
+        Get the MAC address that holds a lease for an IP address
+        :param str|netaddr.IPAddress ip: IPv4 address
+        :return: MAC address formatted like arpreq or None
+        :rtype: str|None
+        """
+        self.refresh()
+        try:
+            mac = self.ip_to_mac.get(parse_ip(ip))
+        except ValueError:
+            return None
+        return format_mac(mac) if mac is not None else None
+
+    def lookup_ip(self, mac):
+        """
+        Get the IP address leased to a MAC address
+        :param str|netaddr.EUI mac: MAC address
+        :rtype: str|None
+        """
+        self.refresh()
+        try:
+            ip = self.mac_to_ip.get(parse_mac(mac))
+        except ValueError:
+            return None
+        return format_ip(ip) if ip is not None else None
+
+    def lookup_macs(self, ips):
+        """
+        Bulk version of :meth:`lookup_mac`.
+
+        The lease file is checked for changes only once.
+        :param Iterable[str|netaddr.IPAddress] ips: IPv4 addresses
+        :return: Mapping of the given IPs to MAC addresses or None
+        :rtype: dict[str|netaddr.IPAddress, str|None]
+        """
+        self.refresh()
+        result = {}
+        for ip in ips:
+            try:
+                mac = self.ip_to_mac.get(parse_ip(ip))
+            except ValueError:
+                mac = None
+            result[ip] = format_mac(mac) if mac is not None else None
+        return result
+
+    def lookup_ips(self, macs):
+        """
+        Bulk version of :meth:`lookup_ip`.
+        :param Iterable[str|netaddr.EUI] macs: MAC addresses
+        :rtype: dict[str|netaddr.EUI, str|None]
+        """
+        self.refresh()
+        result = {}
+        for mac in macs:
+            try:
+                ip = self.mac_to_ip.get(parse_mac(mac))
+            except ValueError:
+                ip = None
+            result[mac] = format_ip(ip) if ip is not None else None
+        return result
+
+    def items(self):
+        """All leases as pairs of formatted IP and MAC addresses"""
+        self.refresh()
+        return ((format_ip(ip), format_mac(mac))
+                for ip, mac in self.ip_to_mac.items())
+
+    def __len__(self):
+        return len(self.ip_to_mac)
+
+    def close(self):
+        if self._inotify is not None:
+            self._inotify.close()
+            self._inotify = None
+
+
+@memoize
+def get_lease_index():
+    """
+    The index of the lease file of the auth dnsmasq shared by the portal and
+    the agent in this process
+    :rtype: LeaseIndex
+    """
+    return LeaseIndex(get_config()['HADES_AUTH_DNSMASQ_LEASE_FILE'])
+
+
+def reset_lease_index(config, changed):
+    index = get_lease_index.cache_get()
+    if index is not None:
+        index.close()
+        get_lease_index.cache_clear()
+
+
+subscribe(reset_lease_index, ('HADES_AUTH_DNSMASQ_LEASE_FILE',))
+
+
+def main(args):
+    """
+    Print the leases of the given IP or MAC addresses or all leases if no
+    addresses are given.
+    """
+    config = CheckWrapper(load_config(lazy=True), runtime_checks=False)
+    index = LeaseIndex(config['HADES_AUTH_DNSMASQ_LEASE_FILE'])
+    if len(args) < 2:
+        for ip, mac in sorted(index.items()):
+            print(ip, mac)
+        return os.EX_OK
+    ips = [a for a in args[1:] if '.' in a]
+    macs = [a for a in args[1:] if '.' not in a]
+    for ip, mac in index.lookup_macs(ips).items():
+        print(ip, mac or '-')
+    for mac, ip in index.lookup_ips(macs).items():
+        print(ip or '-', mac)
+    return os.EX_OK
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -64,7 +64,7 @@ class SignalProxyClient(object):
             raise SignalingError("Remote side shut down connection")
         else:
             try:
-                response = Response(decode(data[0]))
+                response = Response(decode(data[:1]))
             except ValueError as e:
                 raise SignalingError("Server sent invalid response") from e
         self.conn.settimeout(prev_timeout)
@@ -500,14 +500,16 @@ class ClientConnection(object):
 
     def send_responses(self):
         while self.pending_responses:
-            response = encode(self.pending_responses.popleft())
+            response = self.pending_responses.popleft()
             try:
-                sent = self.conn.send(response)
+                sent = self.conn.send(encode(response))
             except InterruptedError:
                 self.pending_responses.appendleft(response)
                 continue
             except BlockingIOError:
                 self.pending_responses.appendleft(response)
+                # Wait until the client has read some of our responses
+                self.poll.modify(self.conn, select.POLLIN | select.POLLOUT)
                 return
             except BrokenPipeError:
                 raise CloseConnection()
@@ -0,0 +1,80 @@
+"""
+Configure the firewall, the policy routing rules and the sysctls of the site
+node.
+
+Only differences between the desired and the live state are applied, so
+that running ``hades networking`` repeatedly is cheap and does not reset
+firewall counters or duplicate rules.
+"""
+import io
+import logging
+import os
+import sys
+import time
+
+from hades.config.generate import ConfigGenerator
+from hades.config.loader import get_config
+from hades.networking.firewall import (
+    FirewallError, apply_iptables, apply_nftables, remove_iptables,
+    remove_nftables)
+from hades.networking.rules import (
+    FwmarkRule, ensure_fwmark_rules, ensure_sysctl)
+
+logger = logging.getLogger(__name__)
+
+SYSCTLS = (
+    ('net.ipv4.ip_nonlocal_bind', '1'),
+)
+
+
+def configure_firewall(config, generator):
+    state_file = config['HADES_FIREWALL_STATE_FILE']
+    if config['HADES_FIREWALL_BACKEND'] == 'nftables':
+        ruleset_file = os.path.join(config['HADES_CONFIG_DIR'],
+                                    'nftables.conf')
+        generator.to_file('nftables.j2', ruleset_file)
+        if apply_nftables(ruleset_file, state_file):
+            logger.info("Loaded nftables ruleset %s", ruleset_file)
+        else:
+            logger.info("nftables ruleset unchanged")
+        removed = remove_iptables(state_file)
+        if removed:
+            logger.info("Removed %d iptables chains of the previous backend",
+                        removed)
+    else:
+        ruleset = io.StringIO()
+        generator.from_file('iptables.j2', ruleset)
+        rewritten, removed = apply_iptables(ruleset.getvalue(), state_file)
+        logger.info("iptables: %d chains rewritten, %d chains removed",
+                    rewritten, removed)
+        if remove_nftables(state_file):
+            logger.info("Deleted nftables table of the previous backend")
+
+
+def main(args):
+    config = get_config()
+    template_dir = os.path.join(os.path.dirname(os.path.dirname(__file__)),
+                                'config', 'templates')
+    generator = ConfigGenerator(template_dir, config)
+    start = time.perf_counter()
+    try:
+        configure_firewall(config, generator)
+    except FirewallError as e:
+        logger.critical("Could not configure the firewall: %s", e)
+        return os.EX_OSERR
+    for name, value in SYSCTLS:
+        if ensure_sysctl(name, value):
+            logger.info("Set %s = %s", name, value)
+    rules = (FwmarkRule(config['HADES_AUTH_FWMARK'],
+                        config['HADES_AUTH_ROUTING_TABLE']),
+             FwmarkRule(config['HADES_UNAUTH_FWMARK'],
+                        config['HADES_UNAUTH_ROUTING_TABLE']))
+    for rule in ensure_fwmark_rules(rules):
+        logger.info("Added rule fwmark %d table %d", rule.fwmark, rule.table)
+    logger.info("Configured networking in %.1f ms",
+                (time.perf_counter() - start) * 1000)
+    return os.EX_OK
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
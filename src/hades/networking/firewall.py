@@ -0,0 +1,349 @@
+"""
+Incremental updates of the firewall.
+
+Loading the complete ruleset with iptables-restore flushes every table and
+resets all counters. Instead, the desired ruleset is rendered from the
+iptables.j2 template, split into chains and compared with the chains applied
+by the previous run. Only chains, whose desired rules changed or whose live
+rules have been modified by someone else since, are rewritten with
+``iptables-restore --noflush``. Each table is still replaced in a single
+atomic commit, unchanged chains keep their counters and the conntrack rules
+at the top of the chains, that accept established connections, are never
+removed while the ruleset is updated.
+
+iptables-save prints rules in a canonical form, that differs from the
+template (e.g. ``--set-mark 1`` becomes ``--set-xmark 0x1/0xffffffff``). The
+state file therefore records both the rendered rules and the live rules
+read back after applying them.
+
+The nftables ruleset is only loaded with nft -f, if the rendered ruleset or
+the live hades table changed.
+
+The ruleset of the other backend is removed, when the backend is switched,
+as both would filter the traffic otherwise.
+"""
+import collections
+import hashlib
+import json
+import logging
+import os
+import subprocess
+
+from hades.common.util import atomic_open
+
+logger = logging.getLogger(__name__)
+
+BUILTIN_CHAINS = frozenset(('PREROUTING', 'INPUT', 'FORWARD', 'OUTPUT',
+                            'POSTROUTING'))
+NFTABLES_TABLE = ('ip', 'hades')
+
+
+class FirewallError(Exception):
+    pass
+
+
+Chain = collections.namedtuple('Chain', ('policy', 'rules'))
+
+
+def parse_ruleset(text):
+    """
+    Parse a ruleset in iptables-save format.
+
+    Counters of the chains are ignored and whitespace in rules is normalized.
+    :param str text: Ruleset
+    :return: Chains by name by table in the order of the ruleset
+    :rtype: dict[str, dict[str, Chain]]
+    :raises ValueError: if the ruleset is malformed
+    """
+    tables = collections.OrderedDict()
+    chains = None
+    for number, line in enumerate(text.splitlines(), 1):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        if line.startswith('*'):
+            chains = tables.setdefault(line[1:], collections.OrderedDict())
+        elif chains is None:
+            raise ValueError("Line {}: Not in a table".format(number))
+        elif line == 'COMMIT':
+            chains = None
+        elif line.startswith(':'):
+            fields = line[1:].split()
+            if len(fields) < 2:
+                raise ValueError("Line {}: Invalid chain".format(number))
+            chains[fields[0]] = Chain(fields[1], [])
+        elif line.startswith('-A '):
+            rule = ' '.join(line.split()[1:])
+            name = rule.split(' ', 1)[0]
+            if name not in chains:
+                raise ValueError("Line {}: Undeclared chain {}"
+                                 .format(number, name))
+            chains[name].rules.append(rule)
+        else:
+            raise ValueError("Line {}: Unsupported command {!r}"
+                             .format(number, line))
+    if chains is not None:
+        raise ValueError("Missing COMMIT")
+    return tables
+
+
+def read_live_ruleset(tables):
+    """
+    Read the live rules of some tables with iptables-save.
+    :param Iterable[str] tables: Names of the tables
+    :rtype: dict[str, dict[str, Chain]]
+    """
+    live = collections.OrderedDict()
+    for table in tables:
+        try:
+            output = subprocess.check_output(['iptables-save', '-t', table],
+                                             universal_newlines=True)
+        except (OSError, subprocess.CalledProcessError) as e:
+            raise FirewallError("Could not read table {}: {}"
+                                .format(table, e)) from e
+        live.update(parse_ruleset(output))
+        live.setdefault(table, collections.OrderedDict())
+    return live
+
+
+def read_state(filename):
+    """
+    :return: The state recorded by the previous run or an empty dict
+    :rtype: dict
+    """
+    try:
+        with open(filename, encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except ValueError as e:
+        logger.warning("Ignoring malformed state file %s: %s", filename, e)
+        return {}
+
+
+def write_state(filename, state):
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    with atomic_open(filename, perms=0o600) as f:
+        json.dump(state, f, indent=2, sort_keys=True)
+
+
+def chain_to_json(chain):
+    return {'policy': chain.policy, 'rules': chain.rules}
+
+
+def changed_chains(desired, live, applied):
+    """
+    Determine the chains, that have to be rewritten.
+    :param dict[str, dict[str, Chain]] desired: Rendered ruleset
+    :param dict[str, dict[str, Chain]] live: Live ruleset
+    :param dict applied: Chains applied by the previous run
+    :return: Chains to rewrite and chains to remove by table
+    :rtype: (dict[str, list[str]], dict[str, list[str]])
+    """
+    rewrite = collections.OrderedDict()
+    remove = collections.OrderedDict()
+    for table, chains in desired.items():
+        live_chains = live.get(table, {})
+        for name, chain in chains.items():
+            previous = applied.get(table, {}).get(name)
+            live_chain = live_chains.get(name)
+            if (previous is None or live_chain is None or
+                    previous['desired'] != chain_to_json(chain) or
+                    previous['live'] != chain_to_json(live_chain)):
+                rewrite.setdefault(table, []).append(name)
+    for table, names in applied.items():
+        chains = desired.get(table, {})
+        live_chains = live.get(table, {})
+        obsolete = [name for name in names
+                    if name not in chains and name in live_chains]
+        if obsolete:
+            remove[table] = obsolete
+    return rewrite, remove
+
+
+def format_restore_input(desired, rewrite, remove):
+    """
+    Create the input of iptables-restore --noflush, that rewrites and
+    removes chains.
+
+    Built-in chains are not flushed by chain declarations in noflush mode,
+    all chains are therefore flushed explicitly. Removed built-in chains
+    are flushed and their policy is reset to ACCEPT.
+    :rtype: str
+    """
+    lines = []
+    for table in collections.OrderedDict.fromkeys(tuple(rewrite) +
+                                                  tuple(remove)):
+        names = rewrite.get(table, [])
+        obsolete = remove.get(table, [])
+        lines.append('*' + table)
+        for name in names:
+            lines.append(':{} {} [0:0]'.format(
+                name, desired[table][name].policy))
+        for name in obsolete:
+            if name in BUILTIN_CHAINS:
+                lines.append(':{} ACCEPT [0:0]'.format(name))
+        for name in names + obsolete:
+            lines.append('-F ' + name)
+        for name in names:
+            lines.extend('-A ' + rule
+                         for rule in desired[table][name].rules)
+        for name in obsolete:
+            if name not in BUILTIN_CHAINS:
+                lines.append('-X ' + name)
+        lines.append('COMMIT')
+    return '\n'.join(lines) + '\n'
+
+
+def restore_iptables(restore_input):
+    logger.debug("Applying\n%s", restore_input)
+    try:
+        subprocess.check_output(['iptables-restore', '--noflush'],
+                                input=restore_input,
+                                stderr=subprocess.STDOUT,
+                                universal_newlines=True)
+    except subprocess.CalledProcessError as e:
+        raise FirewallError("iptables-restore failed: {}"
+                            .format(e.output.strip())) from e
+    except OSError as e:
+        raise FirewallError("Could not run iptables-restore: {}"
+                            .format(e)) from e
+
+
+def apply_iptables(ruleset, state_file):
+    """
+    Apply the changed chains of a ruleset.
+    :param str ruleset: Rendered ruleset in iptables-save format
+    :param str state_file: File, that records the applied chains
+    :return: Number of rewritten and removed chains
+    :rtype: (int, int)
+    :raises FirewallError: if the ruleset could not be applied
+    """
+    try:
+        desired = parse_ruleset(ruleset)
+    except ValueError as e:
+        raise FirewallError("Invalid ruleset: {}".format(e)) from e
+    state = read_state(state_file)
+    applied = state.get('iptables', {})
+    tables = collections.OrderedDict.fromkeys(tuple(desired) +
+                                              tuple(applied))
+    live = read_live_ruleset(tables)
+    rewrite, remove = changed_chains(desired, live, applied)
+    if rewrite or remove:
+        restore_iptables(format_restore_input(desired, rewrite, remove))
+        live = read_live_ruleset(desired)
+    state['iptables'] = {
+        table: {
+            name: {
+                'desired': chain_to_json(chain),
+                'live': chain_to_json(live[table][name]),
+            }
+            for name, chain in chains.items() if name in live[table]
+        }
+        for table, chains in desired.items()
+    }
+    write_state(state_file, state)
+    return (sum(map(len, rewrite.values())),
+            sum(map(len, remove.values())))
+
+
+def remove_iptables(state_file):
+    """
+    Remove the chains applied by :func:`apply_iptables`, e.g. after switching
+    to the nftables backend.
+    :param str state_file: File, that records the applied chains
+    :return: Number of removed chains
+    :rtype: int
+    :raises FirewallError: if the chains could not be removed
+    """
+    state = read_state(state_file)
+    applied = state.get('iptables')
+    if applied is None:
+        return 0
+    live = read_live_ruleset(applied)
+    _, remove = changed_chains({}, live, applied)
+    if remove:
+        restore_iptables(format_restore_input({}, {}, remove))
+    del state['iptables']
+    write_state(state_file, state)
+    return sum(map(len, remove.values()))
+
+
+def nftables_hash(ruleset, live):
+    return hashlib.sha256(ruleset.encode('utf-8') + b'\0' +
+                          live.encode('utf-8')).hexdigest()
+
+
+def read_live_nftables():
+    """
+    :return: The live hades table as printed by nft or None, if it does not
+    exist
+    :rtype: str|None
+    """
+    try:
+        return subprocess.check_output(
+            ('nft', 'list', 'table') + NFTABLES_TABLE,
+            stderr=subprocess.DEVNULL, universal_newlines=True)
+    except subprocess.CalledProcessError:
+        return None
+    except OSError as e:
+        raise FirewallError("Could not run nft: {}".format(e)) from e
+
+
+def apply_nftables(ruleset_file, state_file):
+    """
+    Load a ruleset with nft -f, unless neither the ruleset nor the live
+    table changed since it has been loaded last.
+    :param str ruleset_file: Rendered ruleset
+    :param str state_file: File, that records the hash of the applied ruleset
+    :return: True, if the ruleset has been loaded
+    :rtype: bool
+    :raises FirewallError: if the ruleset could not be loaded
+    """
+    with open(ruleset_file, encoding='utf-8') as f:
+        ruleset = f.read()
+    live = read_live_nftables()
+    state = read_state(state_file)
+    if live is not None and state.get('nftables') == nftables_hash(ruleset,
+                                                                   live):
+        return False
+    try:
+        subprocess.check_output(['nft', '-f', ruleset_file],
+                                stderr=subprocess.STDOUT,
+                                universal_newlines=True)
+    except subprocess.CalledProcessError as e:
+        raise FirewallError("nft failed: {}".format(e.output.strip())) from e
+    except OSError as e:
+        raise FirewallError("Could not run nft: {}".format(e)) from e
+    live = read_live_nftables()
+    state['nftables'] = nftables_hash(ruleset, live or '')
+    write_state(state_file, state)
+    return True
+
+
+def remove_nftables(state_file):
+    """
+    Delete the table loaded by :func:`apply_nftables`, e.g. after switching
+    to the iptables backend.
+    :param str state_file: File, that records the hash of the applied ruleset
+    :return: True, if the table has been deleted
+    :rtype: bool
+    :raises FirewallError: if the table could not be deleted
+    """
+    state = read_state(state_file)
+    if 'nftables' not in state:
+        return False
+    deleted = read_live_nftables() is not None
+    if deleted:
+        try:
+            subprocess.check_output(('nft', 'delete', 'table') +
+                                    NFTABLES_TABLE, stderr=subprocess.STDOUT,
+                                    universal_newlines=True)
+        except subprocess.CalledProcessError as e:
+            raise FirewallError("nft failed: {}"
+                                .format(e.output.strip())) from e
+        except OSError as e:
+            raise FirewallError("Could not run nft: {}".format(e)) from e
+    del state['nftables']
+    write_state(state_file, state)
+    return deleted
@@ -0,0 +1,79 @@
+"""
+Idempotent setup of the policy routing rules and sysctls.
+
+``ip rule add`` adds a duplicate rule every time it is run. The existing
+rules are therefore read first and only missing rules are added.
+"""
+import collections
+import logging
+import os
+import socket
+
+import pyroute2.iproute
+
+logger = logging.getLogger(__name__)
+
+SYSCTL_DIR = '/proc/sys'
+
+
+FwmarkRule = collections.namedtuple('FwmarkRule', ('fwmark', 'table'))
+
+
+def rule_table(msg):
+    # Tables above 255 are only stored in the FRA_TABLE attribute
+    table = msg.get_attr('FRA_TABLE')
+    return msg['table'] if table is None else table
+
+
+def get_fwmark_rules(ip):
+    """
+    Read the IPv4 rules, that select a routing table by firewall mark.
+    :param pyroute2.iproute.IPRoute ip: IPRoute
+    :rtype: set[FwmarkRule]
+    """
+    rules = set()
+    for msg in ip.get_rules(family=socket.AF_INET):
+        fwmark = msg.get_attr('FRA_FWMARK')
+        if fwmark is not None:
+            rules.add(FwmarkRule(fwmark, rule_table(msg)))
+    return rules
+
+
+def ensure_fwmark_rules(rules, ip=None):
+    """
+    Add the rules, that do not exist yet.
+    :param Iterable[FwmarkRule] rules: Rules
+    :param pyroute2.iproute.IPRoute|None ip: IPRoute to use
+    :return: The added rules
+    :rtype: list[FwmarkRule]
+    """
+    if ip is None:
+        with pyroute2.iproute.IPRoute() as ip:
+            return ensure_fwmark_rules(rules, ip)
+    existing = get_fwmark_rules(ip)
+    added = []
+    for rule in rules:
+        if rule in existing:
+            continue
+        ip.rule('add', table=rule.table, fwmark=rule.fwmark,
+                family=socket.AF_INET)
+        existing.add(rule)
+        added.append(rule)
+    return added
+
+
+def ensure_sysctl(name, value):
+    """
+    Set a sysctl, if it has a different value.
+    :param str name: Name of the sysctl, e.g. net.ipv4.ip_nonlocal_bind
+    :param str value: Value
+    :return: True, if the value has been changed
+    :rtype: bool
+    """
+    path = os.path.join(SYSCTL_DIR, *name.split('.'))
+    with open(path, 'r+') as f:
+        if f.read().strip() == value:
+            return False
+        f.seek(0)
+        f.write(value)
+    return True
@@ -1,10 +1,25 @@
 from flask import request
 
 from hades.config.loader import get_config
+from hades.config.watch import ConfigWatcher, subscribe
 from hades.portal import app, babel
 
 app.config.from_object(get_config())
 babel.init_app(app)
+# uWSGI uses SIGHUP itself, therefore the config file is only watched
+config_watcher = ConfigWatcher(signo=None)
+
+
+@app.before_request
+def reload_config():
+    config_watcher.check()
+
+
+@subscribe
+def update_app_config(config, changed):
+    app.config.update((name, config[name]) for name in changed
+                      if name in config)
+
 
 @babel.localeselector
 def get_locale():
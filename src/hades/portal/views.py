@@ -4,6 +4,7 @@ from flask.ext.babel import _, lazy_gettext
 import arpreq
 from hades.portal import app
 from hades.common.db import get_groups, get_latest_auth_attempt
+from hades.dnsmasq.leases import get_lease_index
 
 messages = {
     'traffic': lazy_gettext("You've exceeded your traffic limit."),
@@ -31,11 +32,33 @@ messages = {
                                      "Please contact our support.")
 }
 
+
+def get_mac(ip):
+    """
+    Resolve an IP address into a MAC address.
+
+    The ARP cache is consulted first, as it reflects the host, that actually
+    uses the IP address. The leases of the auth dnsmasq are only used, if
+    the ARP cache has no entry, e.g. because it has expired.
+    :raises OSError: if the ARP lookup failed and no lease exists
+    """
+    try:
+        mac = arpreq.arpreq(ip)
+    except OSError:
+        mac = get_lease_index().lookup_mac(ip)
+        if mac is None:
+            raise
+        return mac
+    if mac is None:
+        mac = get_lease_index().lookup_mac(ip)
+    return mac
+
+
 @app.route("/")
 def index():
     ip = request.remote_addr
     try:
-        mac = arpreq.arpreq(ip)
+        mac = get_mac(ip)
     except OSError as e:
         content = render_template("error.html",
                                   message=_("An error occurred while resolving "
@@ -0,0 +1,267 @@
+"""
+Consumer of the VRRP state transitions of keepalived.
+
+keepalived writes every state transition as a line into its notify_fifo. The
+listener reads the FIFO with the config loaded and the netlink sockets opened
+in advance, so that the actions of a transition are not delayed by the
+startup of a new interpreter on every failover:
+
+* MASTER: The auth and unauth routing tables are synced with the main table
+  and the auth dnsmasq is sent SIGHUP to clear its cache and re-read its
+  hosts file.
+* All states: The state is written to HADES_VRRP_STATE_FILE, which other
+  services (e.g. the agent) can read to determine whether the site node
+  instance is the master.
+
+The duration of every stage of a transition to MASTER is recorded in a
+timeline (see :mod:`hades.vrrp.timeline`).
+"""
+import collections
+from itertools import chain
+import logging
+import os
+import shlex
+import signal
+import stat
+import sys
+import threading
+import time
+
+import pyroute2.iproute
+
+from hades.common.util import atomic_open
+from hades.config.loader import get_config
+from hades.config.watch import ConfigWatcher
+from hades.dnsmasq.monitor import (
+    Response, SignalProxyClient, SignalingError, try_close_fd)
+from hades.vrrp.notify import RT_TABLE_MAIN, RouteBatch, sync_routes
+from hades.vrrp.timeline import (
+    STAGES, Timeline, append_timeline, probe_dns, probe_http)
+
+logger = logging.getLogger(__name__)
+
+STATES = frozenset(('MASTER', 'BACKUP', 'FAULT', 'STOP'))
+
+
+Transition = collections.namedtuple('Transition', ('kind', 'name', 'state',
+                                                   'priority'))
+
+
+def parse_transition(line):
+    """
+    Parse a line of the keepalived notify FIFO.
+
+    Lines consist of the type (INSTANCE or GROUP), the quoted name of the
+    instance or group, the new state and, for instances, the priority, e.g.
+    INSTANCE "unauth" MASTER 100
+    :param str line: Line without trailing newline
+    :rtype: Transition
+    :raises ValueError: if the line is malformed
+    """
+    fields = shlex.split(line)
+    if len(fields) not in (3, 4):
+        raise ValueError("Expected 3 or 4 fields, got {}".format(len(fields)))
+    kind, name, state = fields[:3]
+    if state not in STATES:
+        raise ValueError("Unknown state {}".format(state))
+    priority = int(fields[3]) if len(fields) == 4 else None
+    return Transition(kind, name, state, priority)
+
+
+def open_fifo(filename):
+    """
+    Open the FIFO for reading, create it if it does not exist yet.
+
+    The FIFO is opened read-write, so that there always is a writer and
+    restarts of keepalived do not cause EOF on the FIFO.
+    :return: File descriptor
+    :rtype: int
+    """
+    try:
+        st = os.stat(filename)
+    except FileNotFoundError:
+        os.mkfifo(filename, 0o600)
+    else:
+        if not stat.S_ISFIFO(st.st_mode):
+            raise OSError("{} is not a FIFO".format(filename))
+    return os.open(filename, os.O_RDWR | os.O_CLOEXEC)
+
+
+class VRRPListener(object):
+    """
+    Read state transitions from the notify FIFO of keepalived and dispatch
+    them.
+    """
+    MAX_LINE_LENGTH = 4096
+
+    def __init__(self, fifo):
+        """
+        :param str fifo: Path of the notify FIFO
+        """
+        self.fifo = fifo
+        self.fd = open_fifo(fifo)
+        self.buffer = b''
+        self.config_watcher = ConfigWatcher()
+        self.ip = pyroute2.iproute.IPRoute()
+        self.batch = RouteBatch()
+
+    def read_transitions(self):
+        """
+        Read the next transitions from the FIFO. Blocks until at least one
+        complete line has been read.
+        :rtype: list[Transition]
+        """
+        while b'\n' not in self.buffer:
+            try:
+                data = os.read(self.fd, self.MAX_LINE_LENGTH)
+            except InterruptedError:
+                continue
+            self.buffer += data
+            if len(self.buffer) > self.MAX_LINE_LENGTH and \
+                    b'\n' not in self.buffer:
+                logger.warning("Discarding overlong line %r", self.buffer)
+                self.buffer = b''
+        *lines, self.buffer = self.buffer.split(b'\n')
+        transitions = []
+        for line in lines:
+            try:
+                transitions.append(parse_transition(
+                    line.decode('utf-8', errors='replace')))
+            except ValueError as e:
+                logger.warning("Ignoring malformed notification %r: %s",
+                               line, e)
+        return transitions
+
+    def dispatch(self, transition):
+        timeline = Timeline(transition.state)
+        timeline.mark('notify_received')
+        self.config_watcher.check()
+        config = get_config()
+        start = time.perf_counter()
+        logger.info("%s %s transitioned to %s", transition.kind.capitalize(),
+                    transition.name, transition.state)
+        self.write_state(config, transition.state)
+        if transition.state == 'MASTER':
+            # A failed stage must not prevent the following stages
+            try:
+                self.sync_routes(config)
+            except Exception:
+                logger.exception("Could not sync the routing tables")
+                timeline.fail('routes_synced')
+            else:
+                timeline.mark('routes_synced')
+            try:
+                reloaded = self.reload_dnsmasq(config)
+            except Exception:
+                logger.exception("Could not reload the auth dnsmasq")
+                reloaded = False
+            if reloaded:
+                timeline.mark('dnsmasq_reloaded')
+            else:
+                timeline.fail('dnsmasq_reloaded')
+            # Waiting for the services must not delay further transitions
+            threading.Thread(target=self.probe_services,
+                             args=(config, timeline), daemon=True).start()
+        logger.info("Handled transition to %s in %.1f ms", transition.state,
+                    (time.perf_counter() - start) * 1000)
+
+    def probe_services(self, config, timeline):
+        """
+        Wait until the unauth DNS server and the captive portal answer on the
+        unauth address and record the timeline.
+        """
+        address = str(config['HADES_UNAUTH_LISTEN'].ip)
+        timeout = config['HADES_VRRP_PROBE_TIMEOUT'].total_seconds()
+        for stage, probe in (('dns_answering', probe_dns),
+                             ('portal_answering', probe_http)):
+            if probe(address, timeout):
+                timeline.mark(stage)
+            else:
+                logger.warning("%s timed out after %.0f s", stage, timeout)
+                timeline.fail(stage)
+        logger.info("Transition timeline: %s", ", ".join(
+            "{} {}".format(stage, "failed" if offset is None else
+                           "{:.1f} ms".format(offset * 1000))
+            for stage, offset in ((stage, timeline.stages[stage])
+                                  for stage in STAGES
+                                  if stage in timeline.stages)))
+        try:
+            append_timeline(config['HADES_VRRP_TIMELINE_FILE'], timeline)
+        except OSError as e:
+            logger.error("Could not write timeline: %s", e)
+
+    def write_state(self, config, state):
+        try:
+            with atomic_open(config['HADES_VRRP_STATE_FILE']) as f:
+                f.write(state + '\n')
+        except OSError as e:
+            logger.error("Could not write state file: %s", e)
+
+    def sync_routes(self, config):
+        excludes = tuple(chain(config['HADES_USER_NETWORKS'].values(),
+                               (config['HADES_UNAUTH_LISTEN'],)))
+        tables = (config['HADES_AUTH_ROUTING_TABLE'],
+                  config['HADES_UNAUTH_ROUTING_TABLE'])
+        added, deleted, errors = sync_routes(RT_TABLE_MAIN, tables, excludes,
+                                             ip=self.ip, batch=self.batch)
+        for description, error in errors:
+            logger.error("Could not %s: %s", description, error)
+        logger.info("Synced routing tables %s with main table: %d added, "
+                    "%d deleted, %d failed", ", ".join(map(str, tables)),
+                    added, deleted, len(errors))
+
+    def reload_dnsmasq(self, config):
+        """
+        :return: True, if the signal has been delivered
+        """
+        sockfile = config['HADES_AUTH_DNSMASQ_SIGNAL_SOCKET']
+        try:
+            client = SignalProxyClient(sockfile)
+        except OSError as e:
+            logger.error("Could not connect to the auth dnsmasq monitor at "
+                         "%s: %s", sockfile, e)
+            return False
+        try:
+            response = client.send_signal(signal.SIGHUP, timeout=1)
+            logger.debug("auth dnsmasq monitor responded %s", response)
+            return response == Response.OK
+        except (OSError, SignalingError) as e:
+            logger.error("Could not send SIGHUP to the auth dnsmasq: %s", e)
+            return False
+        finally:
+            client.close()
+
+    def run(self):
+        while True:
+            for transition in self.read_transitions():
+                try:
+                    self.dispatch(transition)
+                except Exception:
+                    logger.exception("Could not handle transition to %s",
+                                     transition.state)
+
+    def close(self):
+        self.batch.close()
+        self.ip.close()
+        try_close_fd(self.fd)
+
+
+def main(args):
+    # The virtual addresses don't exist on backup nodes, the config is
+    # therefore not runtime checked
+    config = get_config()
+    fifo = config['HADES_VRRP_NOTIFY_FIFO']
+    os.makedirs(os.path.dirname(fifo), exist_ok=True)
+    logger.info("Reading VRRP state transitions from %s", fifo)
+    listener = VRRPListener(fifo)
+    try:
+        listener.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        listener.close()
+    return os.EX_OK
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,193 @@
+"""
+Mirror the main routing table into the auth and unauth routing tables.
+
+Route changes of the main table are received as netlink notifications and
+applied to the destination tables as they happen, so that no bulk copy is
+required on a VRRP failover. A full reconciliation with
+:func:`hades.vrrp.notify.sync_routes` is performed on start, periodically and
+if notifications have been lost.
+"""
+import errno
+from itertools import chain
+import logging
+import os
+import select
+import socket
+import sys
+import time
+
+from pyroute2.netlink import rtnl
+from pyroute2.netlink.rtnl.rtmsg import rtmsg
+
+from hades.config.loader import get_config
+from hades.vrrp.notify import (
+    NLMSGHDR, PrefixSet, RT_TABLE_MAIN, RouteBatch, is_excluded,
+    route_from_rtmsg, sync_routes)
+
+logger = logging.getLogger(__name__)
+
+# Errors of incremental changes, that mean that the destination table is
+# already in the desired state
+IGNORED_ERRORS = frozenset((errno.EEXIST, errno.ESRCH))
+
+
+def parse_route_messages(data):
+    """
+    Parse the route messages of a netlink datagram.
+
+    The messages are decoded directly instead of using the receive loop of
+    pyroute2, which may buffer notifications internally, where they are
+    invisible to select.
+    :param bytes data: Datagram
+    :return: Pairs of message type and decoded route messages
+    :rtype: Iterable[(int, rtmsg)]
+    """
+    offset = 0
+    while offset + NLMSGHDR.size <= len(data):
+        length, msg_type, _, _, _ = NLMSGHDR.unpack_from(data, offset)
+        if length < NLMSGHDR.size:
+            break
+        if msg_type in (rtnl.RTM_NEWROUTE, rtnl.RTM_DELROUTE):
+            msg = rtmsg(data[offset:offset + length])
+            msg.decode()
+            yield msg_type, msg
+        # Messages are aligned to 4 bytes
+        offset += (length + 3) & ~3
+
+
+def get_table(msg):
+    table = msg.get_attr('RTA_TABLE')
+    return table if table is not None else msg['table']
+
+
+class RouteMirror(object):
+    """
+    Apply route notifications of a source table to destination tables.
+    """
+    RECEIVE_BUFFER_SIZE = 4 * 1024 * 1024
+    MAX_DATAGRAM_SIZE = 65536
+
+    def __init__(self, from_table, to_tables, excludes, reconcile_interval):
+        """
+        :param int from_table: Source table
+        :param tuple[int] to_tables: Destination tables
+        :param Sequence[netaddr.IPNetwork] excludes: Networks, that are not
+        mirrored (see :func:`hades.vrrp.notify.sync_routes`)
+        :param float reconcile_interval: Seconds between full reconciliations
+        """
+        self.from_table = from_table
+        self.to_tables = to_tables
+        self.excludes = tuple(excludes)
+        self.prefix_set = PrefixSet(self.excludes)
+        self.reconcile_interval = reconcile_interval
+        self.next_reconcile = None
+        self.socket = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW,
+                                    socket.NETLINK_ROUTE)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF,
+                               self.RECEIVE_BUFFER_SIZE)
+        self.socket.bind((0, rtnl.RTMGRP_IPV4_ROUTE | rtnl.RTMGRP_IPV6_ROUTE))
+        self.socket.setblocking(False)
+        self.batch = RouteBatch()
+
+    def reconcile(self):
+        start = time.perf_counter()
+        added, deleted, errors = sync_routes(self.from_table, self.to_tables,
+                                             self.excludes)
+        for description, error in errors:
+            logger.error("Could not %s: %s", description, error)
+        logger.info("Reconciled routing tables %s in %.1f ms: %d added, "
+                    "%d deleted, %d failed",
+                    ", ".join(map(str, self.to_tables)),
+                    (time.perf_counter() - start) * 1000, added, deleted,
+                    len(errors))
+        self.next_reconcile = time.monotonic() + self.reconcile_interval
+
+    def receive(self):
+        """
+        Read all pending notifications.
+        :return: Pairs of message type and route messages
+        :rtype: list[(int, rtmsg)]
+        """
+        messages = []
+        while True:
+            try:
+                data = self.socket.recv(self.MAX_DATAGRAM_SIZE)
+            except InterruptedError:
+                continue
+            except BlockingIOError:
+                return messages
+            messages.extend(parse_route_messages(data))
+
+    def apply(self, messages):
+        """
+        Apply notifications about routes of the source table.
+        """
+        for msg_type, msg in messages:
+            if get_table(msg) != self.from_table:
+                continue
+            route = route_from_rtmsg(msg)
+            if is_excluded(route, self.prefix_set):
+                continue
+            for table in self.to_tables:
+                if msg_type == rtnl.RTM_NEWROUTE:
+                    self.batch.add(route, table, replace=True)
+                else:
+                    self.batch.delete(route, table)
+        if not len(self.batch):
+            return
+        count = len(self.batch)
+        errors = [(d, e) for d, e in self.batch.commit()
+                  if e.errno not in IGNORED_ERRORS]
+        for description, error in errors:
+            logger.error("Could not %s: %s", description, error)
+        logger.debug("Applied %d route changes, %d failed", count,
+                     len(errors))
+
+    def run(self):
+        self.reconcile()
+        while True:
+            timeout = max(self.next_reconcile - time.monotonic(), 0)
+            try:
+                readable, _, _ = select.select([self.socket], [], [],
+                                               timeout)
+            except InterruptedError:
+                continue
+            if not readable:
+                self.reconcile()
+                continue
+            try:
+                messages = self.receive()
+            except OSError as e:
+                if e.errno != errno.ENOBUFS:
+                    raise
+                logger.warning("Route notifications have been lost, "
+                               "reconciling")
+                self.reconcile()
+                continue
+            self.apply(messages)
+
+    def close(self):
+        self.batch.close()
+        self.socket.close()
+
+
+def main(args):
+    config = get_config()
+    excludes = tuple(chain(config['HADES_USER_NETWORKS'].values(),
+                           (config['HADES_UNAUTH_LISTEN'],)))
+    tables = (config['HADES_AUTH_ROUTING_TABLE'],
+              config['HADES_UNAUTH_ROUTING_TABLE'])
+    interval = config['HADES_ROUTE_MIRROR_RECONCILE_INTERVAL']
+    mirror = RouteMirror(RT_TABLE_MAIN, tables, excludes,
+                         interval.total_seconds())
+    try:
+        mirror.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        mirror.close()
+    return os.EX_OK
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
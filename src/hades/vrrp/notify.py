@@ -1,9 +1,13 @@
 import collections
+import contextlib
 from itertools import chain
 import logging
+import os
+import socket
+import struct
 import sys
+import time
 
-import netaddr
 from pyroute2 import netlink
 from pyroute2.netlink import rtnl
 from pyroute2.netlink.rtnl import rtmsg
@@ -46,14 +50,128 @@ def unfreeze(value):
     return value
 
 
-Route = collections.namedtuple('Route', ('family', 'dst_len', 'src_len', 'tos',
-                                         'proto', 'scope', 'type', 'attributes',
-                                         'flags'))
 INCLUDED_ATTRIBUTES = {
     'RTA_DST', 'RTA_SRC', 'RTA_OIF', 'RTA_GATEWAY', 'RTA_PRIORITY',
     'RTA_PREFSRC', 'RTA_MULTIPATH', 'RTA_METRICS', 'RTA_FLOW', 'RTA_VIA',
     'RTA_NEWDST', 'RTA_PREF',
 }
+# Numbers of the attributes in the kernel ABI (linux/rtnetlink.h)
+ATTRIBUTE_TYPES = {
+    'RTA_DST': 1, 'RTA_SRC': 2, 'RTA_OIF': 4, 'RTA_GATEWAY': 5,
+    'RTA_PRIORITY': 6, 'RTA_PREFSRC': 7, 'RTA_METRICS': 8,
+    'RTA_MULTIPATH': 9, 'RTA_FLOW': 11, 'RTA_TABLE': 15, 'RTA_VIA': 18,
+    'RTA_NEWDST': 19, 'RTA_PREF': 20,
+}
+ATTRIBUTE_NAMES = {number: name for name, number in ATTRIBUTE_TYPES.items()}
+ADDRESS_ATTRIBUTES = frozenset(('RTA_DST', 'RTA_SRC', 'RTA_GATEWAY',
+                                'RTA_PREFSRC'))
+U32_ATTRIBUTES = frozenset(('RTA_OIF', 'RTA_PRIORITY', 'RTA_FLOW'))
+U8_ATTRIBUTES = frozenset(('RTA_PREF',))
+RTA_DST = ATTRIBUTE_TYPES['RTA_DST']
+
+# struct rtmsg without the table (family, dst_len, src_len, tos, protocol,
+# scope, type, flags)
+ROUTE_HEADER = struct.Struct('=BBBBBBBI')
+# struct rtattr
+RTATTR = struct.Struct('=HH')
+U32 = struct.Struct('=I')
+U8 = struct.Struct('=B')
+# Complete attributes with integer payload including padding
+RTATTR_U32 = struct.Struct('=HHI')
+RTATTR_U8 = struct.Struct('=HHB3x')
+# RTA_DST has the lowest type and is therefore the first attribute of route
+# keys, if the route has a destination. Position of its type and address:
+DESTINATION_TYPE_SLICE = slice(ROUTE_HEADER.size + 2, ROUTE_HEADER.size + 4)
+DESTINATION_OFFSET = ROUTE_HEADER.size + RTATTR.size
+ENCODED_RTA_DST = struct.pack('=H', RTA_DST)
+
+
+def iter_attributes(data, offset=0):
+    """
+    Decode encoded route attributes
+    :param bytes data: Encoded attributes
+    :param int offset: Offset of the first attribute
+    :return: Pairs of attribute type and payload
+    :rtype: Iterable[(int, bytes)]
+    """
+    while offset < len(data):
+        length, number = RTATTR.unpack_from(data, offset)
+        yield number, data[offset + RTATTR.size:offset + length]
+        offset += (length + 3) & ~3
+
+
+class Route(object):
+    """
+    Compact, hashable representation of a route.
+
+    A route is identified by a single bytes object, its key: the fields of
+    struct rtmsg without the table, followed by the addresses and integer
+    attributes in their netlink encoding, sorted by attribute type. Keys are
+    used for comparisons and hashing and become the payload of netlink
+    requests without any conversion. Attributes with nested values
+    (e.g. RTA_MULTIPATH or RTA_METRICS) are rare and kept as frozen values.
+    """
+    __slots__ = ('key', 'nested_attributes', '_hash')
+
+    def __init__(self, family, dst_len, src_len, tos, proto, scope, type,
+                 flags, encoded_attributes=b'', nested_attributes=()):
+        """
+        :param bytes encoded_attributes: Encoded simple attributes sorted by
+        type
+        :param tuple[(str, object)] nested_attributes: Sorted pairs of
+        names and frozen values of all other attributes
+        """
+        self.key = ROUTE_HEADER.pack(family, dst_len, src_len, tos, proto,
+                                     scope, type, flags) + encoded_attributes
+        self.nested_attributes = nested_attributes
+        self._hash = hash((self.key, nested_attributes))
+
+    family = property(lambda self: self.key[0])
+    dst_len = property(lambda self: self.key[1])
+    src_len = property(lambda self: self.key[2])
+    tos = property(lambda self: self.key[3])
+    proto = property(lambda self: self.key[4])
+    scope = property(lambda self: self.key[5])
+    type = property(lambda self: self.key[6])
+    flags = property(lambda self: ROUTE_HEADER.unpack_from(self.key)[7])
+
+    @property
+    def attributes(self):
+        """
+        All attributes with decoded values
+        :rtype: dict[str, object]
+        """
+        attributes = {}
+        for number, data in iter_attributes(self.key, ROUTE_HEADER.size):
+            name = ATTRIBUTE_NAMES[number]
+            if name in ADDRESS_ATTRIBUTES:
+                attributes[name] = socket.inet_ntop(self.family, data)
+            elif name in U32_ATTRIBUTES:
+                attributes[name], = U32.unpack(data)
+            else:
+                attributes[name], = U8.unpack(data)
+        attributes.update(self.nested_attributes)
+        return attributes
+
+    def __eq__(self, other):
+        if not isinstance(other, Route):
+            return NotImplemented
+        return (self.key == other.key and
+                self.nested_attributes == other.nested_attributes)
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        return result if result is NotImplemented else not result
+
+    def __hash__(self):
+        return self._hash
+
+    def __repr__(self):
+        return ("Route(family={}, dst_len={}, src_len={}, tos={}, proto={}, "
+                "scope={}, type={}, flags={}, attributes={!r})".format(
+                    self.family, self.dst_len, self.src_len, self.tos,
+                    self.proto, self.scope, self.type, self.flags,
+                    self.attributes))
 
 
 def route_from_rtmsg(rtmsg):
@@ -66,11 +184,31 @@ def route_from_rtmsg(rtmsg):
 
     :param netaddr.netlink.rtnl.rtmsg.rtmsg: rtmsg object
     """
-    attributes = frozendict({k: freeze(v) for k, v in rtmsg['attrs']
-                             if k in INCLUDED_ATTRIBUTES})
-    return Route(rtmsg['family'], rtmsg['dst_len'], rtmsg['src_len'],
-                 rtmsg['tos'], rtmsg['proto'], rtmsg['scope'], rtmsg['type'],
-                 freeze(attributes), rtmsg['flags'])
+    family = rtmsg['family']
+    encoded = []
+    nested = []
+    for name, value in rtmsg['attrs']:
+        if name in ADDRESS_ATTRIBUTES:
+            number = ATTRIBUTE_TYPES[name]
+            data = socket.inet_pton(family, value)
+            encoded.append((number, RTATTR.pack(RTATTR.size + len(data),
+                                                number) + data))
+        elif name in U32_ATTRIBUTES:
+            number = ATTRIBUTE_TYPES[name]
+            encoded.append((number, RTATTR_U32.pack(RTATTR_U32.size, number,
+                                                    value)))
+        elif name in U8_ATTRIBUTES:
+            number = ATTRIBUTE_TYPES[name]
+            encoded.append((number, RTATTR_U8.pack(RTATTR.size + 1, number,
+                                                   value)))
+        elif name in INCLUDED_ATTRIBUTES:
+            nested.append((name, freeze(value)))
+    encoded.sort()
+    nested.sort()
+    return Route(family, rtmsg['dst_len'], rtmsg['src_len'], rtmsg['tos'],
+                 rtmsg['proto'], rtmsg['scope'], rtmsg['type'],
+                 rtmsg['flags'], b''.join(data for _, data in encoded),
+                 tuple(nested))
 
 
 def rtmsg_from_route(route, table):
@@ -96,69 +234,314 @@ def rtmsg_from_route(route, table):
 
 def get_routes(ip, table):
     """
-    Obtain all routes from a routing table
+    Obtain all IPv4 and IPv6 routes from a routing table
     :param pyroute2.iproute.IPRoute ip: IPRoute object
     :param int table: routing table
     """
-    return map(route_from_rtmsg, ip.get_routes(table=table))
+    # pyroute2 only dumps IPv4 routes, if no family is given
+    return map(route_from_rtmsg, chain.from_iterable(
+        ip.get_routes(family=family, table=table)
+        for family in (socket.AF_INET, socket.AF_INET6)))
+
+
+# struct nlmsghdr
+NLMSGHDR = struct.Struct('=LHHLL')
+# struct nlmsgerr without the original message
+NLMSGERR = struct.Struct('=i')
 
 
-def add_routes(ip, table, routes):
+def encode_message(msg):
     """
-    Add routes to a routing table
-    :param pyroute2.iproute.IPRoute ip: IPRoute object
-    :param int table: routing table
-    :param Iterable[Route] routes: Routes to add
+    Encode a netlink message
+    :param pyroute2.netlink.nlmsg msg: Message with a complete header
+    :rtype: bytes
+    """
+    msg.encode()
+    data = getattr(msg, 'data', None)
+    if data is None:
+        # pyroute2 < 0.4 encodes into a BytesIO object
+        data = msg.buf.getvalue()
+    return bytes(data[:msg['header']['length']])
+
+
+def encode_route(route, table, msg_type, flags, sequence_number):
+    """
+    Encode a route request.
+
+    The key of the route is used as is, only routes with
+    nested attributes (e.g. RTA_MULTIPATH or RTA_METRICS) are encoded by
+    pyroute2.
+    :param Route route: Route
+    :param int table: Routing table
+    :param int msg_type: RTM_NEWROUTE or RTM_DELROUTE
+    :param int flags: Netlink flags
+    :param int sequence_number: Sequence number
+    :rtype: bytes
     """
-    flags = netlink.NLM_F_REQUEST | netlink.NLM_F_ACK | netlink.NLM_F_CREATE
-    for route in routes:
+    if route.nested_attributes:
         msg = rtmsg_from_route(route, table)
-        ip.nlm_request(msg, msg_type=rtnl.RTM_NEWROUTE, msg_flags=flags)
+        msg['header']['type'] = msg_type
+        msg['header']['flags'] = flags
+        msg['header']['sequence_number'] = sequence_number
+        msg['header']['pid'] = 0
+        return encode_message(msg)
+    # The table follows tos in struct rtmsg
+    payload = b''.join((
+        route.key[:4],
+        U8.pack(table if table < 256 else RT_TABLE_UNSPEC),
+        route.key[4:],
+        RTATTR_U32.pack(RTATTR_U32.size, ATTRIBUTE_TYPES['RTA_TABLE'], table),
+    ))
+    return NLMSGHDR.pack(NLMSGHDR.size + len(payload), msg_type, flags,
+                         sequence_number, 0) + payload
+
 
+class RouteBatch(object):
+    """
+    Pipelined route changes.
 
-def delete_routes(ip, table, routes):
+    All changes are sent over a single netlink socket without waiting for the
+    ACK of each message. At most WINDOW messages are in flight, so that the
+    ACKs can't overflow the receive buffer of the socket. Every message is
+    acknowledged, failures are collected instead of aborting the batch.
+    """
+    WINDOW = 256
+    RECEIVE_BUFFER_SIZE = 1024 * 1024
+
+    def __init__(self):
+        self.messages = []
+        self.changes = []
+        self.socket = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW,
+                                    socket.NETLINK_ROUTE)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF,
+                               self.RECEIVE_BUFFER_SIZE)
+        self.socket.bind((0, 0))
+
+    def add(self, route, table, replace=False):
+        """
+        :param bool replace: Replace an existing route with the same key
+        (destination, TOS and priority) instead of failing with EEXIST
+        """
+        flags = (netlink.NLM_F_REQUEST | netlink.NLM_F_ACK |
+                 netlink.NLM_F_CREATE)
+        flags |= netlink.NLM_F_REPLACE if replace else netlink.NLM_F_EXCL
+        self._append(rtnl.RTM_NEWROUTE, flags, route, table, "add")
+
+    def delete(self, route, table):
+        self._append(rtnl.RTM_DELROUTE,
+                     netlink.NLM_F_REQUEST | netlink.NLM_F_ACK,
+                     route, table, "delete")
+
+    def _append(self, msg_type, flags, route, table, action):
+        # Sequence numbers are the index of the message plus one
+        self.messages.append(encode_route(route, table, msg_type, flags,
+                                          len(self.messages) + 1))
+        # Descriptions are only formatted for failed changes
+        self.changes.append((action, route, table))
+
+    def __len__(self):
+        return len(self.messages)
+
+    def commit(self):
+        """
+        Send all messages and wait for their ACKs.
+        :return: Pairs of the description of failed changes and OSErrors
+        :rtype: list[(str, OSError)]
+        """
+        errors = []
+        sent = 0
+        acknowledged = set()
+        total = len(self.messages)
+        while len(acknowledged) < total:
+            window_end = min(len(acknowledged) + self.WINDOW, total)
+            if sent < window_end:
+                self.socket.send(b''.join(self.messages[sent:window_end]))
+                sent = window_end
+            data = self.socket.recv(self.RECEIVE_BUFFER_SIZE)
+            for seq, error in self._parse_acks(data):
+                if seq < 1 or seq > sent or seq in acknowledged:
+                    continue
+                acknowledged.add(seq)
+                if error:
+                    errors.append((
+                        "{} {} in table {}".format(*self.changes[seq - 1]),
+                        OSError(error, os.strerror(error))))
+        self.messages = []
+        self.changes = []
+        return errors
+
+    @staticmethod
+    def _parse_acks(data):
+        offset = 0
+        while offset + NLMSGHDR.size <= len(data):
+            length, msg_type, _, seq, _ = NLMSGHDR.unpack_from(data, offset)
+            if length < NLMSGHDR.size:
+                break
+            if msg_type == netlink.NLMSG_ERROR:
+                error, = NLMSGERR.unpack_from(data, offset + NLMSGHDR.size)
+                yield seq, -error
+            # Messages are aligned to 4 bytes
+            offset += (length + 3) & ~3
+
+    def close(self):
+        self.socket.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class PrefixSet(object):
+    """
+    Set of IP networks for fast containment checks of networks.
+
+    The networks are stored as sets of integer prefixes per IP version and
+    prefix length. A network is contained if its address shifted to one of
+    the prefix lengths that are not longer than its own is in the
+    corresponding set. Only the few distinct prefix lengths of the networks
+    in the set have to be tried.
+    """
+    BITS = {socket.AF_INET: 32, socket.AF_INET6: 128}
+
+    def __init__(self, networks=()):
+        # family -> [(prefix length, set of prefixes)] sorted by length
+        self._prefixes = {family: [] for family in self.BITS}
+        for network in networks:
+            self.add(network)
+
+    def add(self, network):
+        """
+        :param netaddr.IPNetwork network: Network
+        """
+        family = socket.AF_INET if network.version == 4 else socket.AF_INET6
+        shift = self.BITS[family] - network.prefixlen
+        by_length = self._prefixes[family]
+        for length, prefixes in by_length:
+            if length == network.prefixlen:
+                prefixes.add(network.value >> shift)
+                return
+        by_length.append((network.prefixlen, {network.value >> shift}))
+        by_length.sort(key=lambda item: item[0])
+
+    def contains(self, family, address, prefixlen):
+        """
+        Check if a network is equal to or contained in one of the networks of
+        the set.
+        :param int family: AF_INET or AF_INET6
+        :param int address: Network address as integer
+        :param int prefixlen: Prefix length
+        """
+        bits = self.BITS[family]
+        for length, prefixes in self._prefixes[family]:
+            if length > prefixlen:
+                break
+            if address >> (bits - length) in prefixes:
+                return True
+        return False
+
+
+def is_excluded(route, excludes):
+    """
+    Check if the destination of a route is equal to or in one of the
+    excluded networks.
+    :param Route route: Route
+    :param PrefixSet excludes: Excluded networks
+    """
+    key = route.key
+    family = key[0]
+    bits = PrefixSet.BITS.get(family)
+    if bits is None or key[DESTINATION_TYPE_SLICE] != ENCODED_RTA_DST:
+        return False
+    address = int.from_bytes(
+        key[DESTINATION_OFFSET:DESTINATION_OFFSET + bits // 8], 'big')
+    return excludes.contains(family, address, key[1])
+
+
+def get_included_routes(ip, table, excludes):
     """
-    Delete routes from a routing table
     :param pyroute2.iproute.IPRoute ip: IPRoute object
-    :param int table: routing table
-    :param Iterable[Route] routes: Routes to delete
+    :param int table: Routing table
+    :param PrefixSet excludes: Excluded networks
+    :return: The routes of a table, whose destination is not excluded
+    :rtype: set[Route]
     """
-    flags = netlink.NLM_F_REQUEST | netlink.NLM_F_ACK
-    for route in routes:
-        msg = rtmsg_from_route(route, table)
-        ip.nlm_request(msg, msg_type=rtnl.RTM_DELROUTE, msg_flags=flags)
+    return {route for route in get_routes(ip, table)
+            if not is_excluded(route, excludes)}
 
 
-def copy_routes(from_table, to_table, excludes):
+def queue_changes(batch, table, new_routes, existing_routes):
+    """
+    Queue the requests, that make the routes of a table equal to new_routes.
+    :param RouteBatch batch: Batch
+    :param int table: Routing table
+    :param set[Route] new_routes: Desired routes
+    :param set[Route] existing_routes: Current routes of the table
+    :return: Number of added and deleted routes
+    :rtype: (int, int)
     """
-    Copy entries between routing tables
+    stale = existing_routes - new_routes
+    missing = new_routes - existing_routes
+    for route in stale:
+        batch.delete(route, table)
+    for route in missing:
+        batch.add(route, table)
+    return len(missing), len(stale)
 
+
+def sync_routes(from_table, to_tables, excludes, ip=None, batch=None):
+    """
+    Make the routes of a number of routing tables equal to the routes of
+    another table.
+
+    Routes with a destination in the excluded networks are neither copied nor
+    deleted, as they are managed by keepalived (virtual_routes). Stale routes
+    in the excluded networks are therefore not removed from the destination
+    tables either, keepalived removes its routes itself. All changes to all
+    tables are sent as a single pipelined batch.
     :param int from_table: Source table
-    :param int to_table: Destination table
-    :param collections.Sequence[netaddr.IPNetwork] excludes: Routes with
-    destination equal to or in these networks will be skipped
-    """
-    new_routes = set()
-    with pyroute2.iproute.IPRoute() as ip:
-        for route in get_routes(ip, from_table):
-            dst = route.attributes.get('RTA_DST')
-            if dst is not None:
-                dst_net = netaddr.IPNetwork("{}/{}".format(dst, route.dst_len))
-                if any(dst_net in network for network in excludes):
-                    continue
-            new_routes.add(route)
-        existing_routes = set(get_routes(ip, to_table))
-        delete_routes(ip, to_table, existing_routes - new_routes)
-        add_routes(ip, to_table, new_routes - existing_routes)
+    :param Iterable[int] to_tables: Destination tables
+    :param collections.Sequence[netaddr.IPNetwork] excludes: Excluded networks
+    :param pyroute2.iproute.IPRoute ip: IPRoute object to reuse (optional)
+    :param RouteBatch batch: Empty batch to reuse (optional)
+    :return: Number of added and deleted routes and the failed changes
+    :rtype: (int, int, list[(str, OSError)])
+    """
+    excludes = PrefixSet(excludes)
+    added = deleted = 0
+    with contextlib.ExitStack() as stack:
+        if ip is None:
+            ip = stack.enter_context(pyroute2.iproute.IPRoute())
+        if batch is None:
+            batch = stack.enter_context(RouteBatch())
+        new_routes = get_included_routes(ip, from_table, excludes)
+        for table in to_tables:
+            existing_routes = get_included_routes(ip, table, excludes)
+            table_added, table_deleted = queue_changes(
+                batch, table, new_routes, existing_routes)
+            added += table_added
+            deleted += table_deleted
+        errors = batch.commit()
+    return added, deleted, errors
 
 
 def main(args):
     config = get_config()
     excludes = tuple(chain(config['HADES_USER_NETWORKS'].values(),
                            (config['HADES_UNAUTH_LISTEN'],)))
-    table = config['HADES_AUTH_ROUTING_TABLE']
-    copy_routes(RT_TABLE_MAIN, table, excludes)
-    return 0
+    tables = (config['HADES_AUTH_ROUTING_TABLE'],
+              config['HADES_UNAUTH_ROUTING_TABLE'])
+    start = time.perf_counter()
+    added, deleted, errors = sync_routes(RT_TABLE_MAIN, tables, excludes)
+    elapsed = time.perf_counter() - start
+    for description, error in errors:
+        logger.error("Could not %s: %s", description, error)
+    logger.info("Synced routing tables %s with main table in %.1f ms: "
+                "%d added, %d deleted, %d failed",
+                ", ".join(map(str, tables)), elapsed * 1000, added, deleted,
+                len(errors))
+    return os.EX_OK if not errors else os.EX_SOFTWARE
 
 
 if __name__ == '__main__':
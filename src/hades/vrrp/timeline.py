@@ -0,0 +1,229 @@
+"""
+Timelines of the transitions to MASTER.
+
+The VRRP listener records the time of each stage of a takeover relative to
+the moment the transition has been read from the notify FIFO of keepalived.
+Timelines are appended as JSON lines to HADES_VRRP_TIMELINE_FILE. Running
+this module prints percentiles of every stage over the recent transitions::
+
+    python3 -m hades.vrrp.timeline --limit 20
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import socket
+import struct
+import sys
+import time
+
+from hades.config.loader import get_config
+
+logger = logging.getLogger(__name__)
+
+# Stages in the order they are reached
+STAGES = ('notify_received', 'routes_synced', 'dnsmasq_reloaded',
+          'dns_answering', 'portal_answering')
+PERCENTILES = (50, 90, 99)
+# Number of timelines that are kept in the timeline file
+MAX_TIMELINES = 1000
+
+
+class Timeline(object):
+    """
+    Offsets of the stages of a single transition.
+    """
+    def __init__(self, state):
+        self.state = state
+        self.started = time.time()
+        self._start = time.monotonic()
+        self.stages = {}
+
+    def mark(self, stage):
+        """Record that a stage has been reached now"""
+        self.stages[stage] = time.monotonic() - self._start
+
+    def fail(self, stage):
+        """Record that a stage has not been reached"""
+        self.stages[stage] = None
+
+    def to_dict(self):
+        return {
+            'state': self.state,
+            'started': self.started,
+            'stages': self.stages,
+        }
+
+
+def append_timeline(filename, timeline):
+    """
+    Append a timeline to the timeline file. The oldest timelines are removed,
+    if the file contains more than MAX_TIMELINES.
+    :param str filename: Timeline file
+    :param Timeline timeline: Timeline
+    """
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    with open(filename, 'a+', encoding='utf-8') as f:
+        f.write(json.dumps(timeline.to_dict(), sort_keys=True) + '\n')
+        f.seek(0)
+        lines = f.readlines()
+        if len(lines) > MAX_TIMELINES:
+            f.seek(0)
+            f.truncate()
+            f.writelines(lines[-MAX_TIMELINES:])
+
+
+def read_timelines(filename, limit=None):
+    """
+    Read the most recent timelines.
+    :param str filename: Timeline file
+    :param int|None limit: Maximum number of timelines
+    :return: Timelines as dicts, oldest first
+    :rtype: list[dict]
+    """
+    timelines = []
+    try:
+        with open(filename, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    timelines.append(json.loads(line))
+                except ValueError:
+                    logger.warning("Ignoring malformed timeline %r", line)
+    except FileNotFoundError:
+        pass
+    return timelines[-limit:] if limit else timelines
+
+
+def percentile(values, p):
+    """
+    Nearest-rank percentile.
+    :param list[float] values: Sorted values
+    :param int p: Percentile
+    """
+    index = max(0, -(-len(values) * p // 100) - 1)
+    return values[index]
+
+
+def summarize(timelines):
+    """
+    Percentiles of the offsets of all stages.
+    :param Iterable[dict] timelines: Timelines as returned by
+    :func:`read_timelines`
+    :return: Statistics per stage
+    :rtype: dict[str, dict]
+    """
+    offsets = {stage: [] for stage in STAGES}
+    failed = {stage: 0 for stage in STAGES}
+    for timeline in timelines:
+        for stage, offset in timeline['stages'].items():
+            if stage not in offsets:
+                continue
+            if offset is None:
+                failed[stage] += 1
+            else:
+                offsets[stage].append(offset)
+    summary = {}
+    for stage in STAGES:
+        values = sorted(offsets[stage])
+        if not values:
+            summary[stage] = {'count': 0, 'failed': failed[stage]}
+            continue
+        summary[stage] = {
+            'count': len(values),
+            'failed': failed[stage],
+            'max': values[-1],
+        }
+        for p in PERCENTILES:
+            summary[stage]['p{}'.format(p)] = percentile(values, p)
+    return summary
+
+
+def probe_dns(address, timeout):
+    """
+    Wait until a DNS server answers queries.
+    :param str address: IPv4 address of the DNS server
+    :param float timeout: Seconds to wait
+    :return: True, if the server answered in time
+    """
+    deadline = time.monotonic() + timeout
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            query_id = random.getrandbits(16)
+            # Header with recursion desired and a single A query for hades.
+            query = struct.pack('!HHHHHH', query_id, 0x0100, 1, 0, 0, 0)
+            query += b'\x05hades\x00' + struct.pack('!HH', 1, 1)
+            sock.settimeout(min(remaining, 0.1))
+            try:
+                sock.sendto(query, (address, 53))
+                response = sock.recv(512)
+            except OSError:
+                # Timeouts and ICMP errors, e.g. if dnsmasq is not
+                # listening yet
+                time.sleep(min(0.01, max(deadline - time.monotonic(), 0)))
+                continue
+            if len(response) >= 2 and \
+                    struct.unpack_from('!H', response)[0] == query_id:
+                return True
+
+
+def probe_http(address, timeout, port=80):
+    """
+    Wait until an HTTP server answers requests.
+    :param str address: IPv4 address of the HTTP server
+    :param float timeout: Seconds to wait
+    :return: True, if the server answered in time
+    """
+    deadline = time.monotonic() + timeout
+    request = 'HEAD / HTTP/1.0\r\nHost: {}\r\n\r\n'.format(address).encode()
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return False
+        try:
+            with socket.create_connection((address, port),
+                                          min(remaining, 1)) as sock:
+                sock.sendall(request)
+                if sock.recv(5) == b'HTTP/':
+                    return True
+        except OSError:
+            pass
+        time.sleep(min(0.01, max(deadline - time.monotonic(), 0)))
+
+
+def main(args):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--limit', type=int, default=100,
+                        help="Number of recent transitions (default: 100)")
+    parser.add_argument('--json', action='store_true',
+                        help="Print the summary as JSON")
+    options = parser.parse_args(args[1:])
+    config = get_config()
+    timelines = read_timelines(config['HADES_VRRP_TIMELINE_FILE'],
+                               options.limit)
+    summary = summarize(timelines)
+    if options.json:
+        json.dump({'transitions': len(timelines), 'stages': summary},
+                  sys.stdout, indent=2, sort_keys=True)
+        print()
+        return os.EX_OK
+    print("{} transitions to MASTER".format(len(timelines)))
+    columns = ['p{}'.format(p) for p in PERCENTILES] + ['max']
+    print("{:<18}{}  {:>6}".format(
+        "stage", "".join("{:>10}".format(c) for c in columns), "failed"))
+    for stage in STAGES:
+        stats = summary[stage]
+        if stats['count']:
+            values = "".join("{:>7.1f} ms".format(stats[c] * 1000)
+                             for c in columns)
+        else:
+            values = "".join("{:>10}".format("-") for _ in columns)
+        print("{:<18}{}  {:>6}".format(stage, values, stats['failed']))
+    return os.EX_OK
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -1,11 +1,53 @@
-from setuptools import Extension, find_packages, setup
+import os
+import re
+import runpy
+
+from setuptools import Command, Extension, find_packages, setup
+from setuptools.command.build_py import build_py as _build_py
 from babel.messages import frontend as babel
 
+with open('hades/__init__.py', encoding='utf-8') as f:
+    version = re.search(r"^__version__ = '([^']*)'", f.read(), re.M).group(1)
+
+
+class compile_templates(Command):
+    description = "precompile the Jinja2 configuration templates"
+    user_options = [
+        ('build-lib=', 'd', "directory to \"build\" (copy) to"),
+    ]
+
+    def initialize_options(self):
+        self.build_lib = None
+
+    def finalize_options(self):
+        self.set_undefined_options('build_py', ('build_lib', 'build_lib'))
+
+    def run(self):
+        # Importing the hades package would configure logging and require
+        # all runtime dependencies
+        templating = runpy.run_path(os.path.join('hades', 'config',
+                                                 'templating.py'))
+        config_dir = os.path.join(self.build_lib, 'hades', 'config')
+        template_dir = os.path.join(config_dir, 'templates')
+        target_dir = os.path.join(config_dir,
+                                  templating['COMPILED_TEMPLATES_DIRNAME'])
+        if self.dry_run:
+            return
+        templating['compile_templates'](template_dir, target_dir,
+                                        self.announce)
+
+
+class build_py(_build_py):
+    def run(self):
+        super().run()
+        self.run_command('compile_templates')
+
+
 arpreq = Extension('arpreq', sources=['arpreq/arpreq.c'],
                    extra_compile_args=['-std=c99'])
 
 setup(name='hades',
-      version='0.1',
+      version=version,
       description="Distributed AG DSN RADIUS MAC authentication. "
                   "Site node agent and captive portal",
       packages=find_packages(exclude=["*.tests"]),
@@ -21,8 +63,10 @@ setup(name='hades',
           "pyroute2",
       ],
       ext_modules=[arpreq],
-      scripts=['scripts/hades'],
+      scripts=['scripts/hades', 'scripts/hades-dhcp-script'],
       cmdclass={
+          'build_py': build_py,
+          'compile_templates': compile_templates,
           'compile_catalog': babel.compile_catalog,
           'extract_messages': babel.extract_messages,
           'init_catalog': babel.init_catalog,
@@ -43,4 +87,3 @@ setup(name='hades',
           'Topic :: System :: Networking',
       ],
       )
-